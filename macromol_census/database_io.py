@@ -48,6 +48,24 @@ def init_db(db):
                 struct_id INT NOT NULL,
                 FOREIGN KEY (struct_id) REFERENCES structure(id)
             );
+
+            -- The size and modification time of the file each structure was
+            -- ingested from.  This makes it possible to tell which structures
+            -- have been revised since they were ingested.
+            CREATE TABLE IF NOT EXISTS structure_file (
+                struct_id INT NOT NULL,
+                size_bytes BIGINT NOT NULL,
+                mtime_ns BIGINT NOT NULL,
+                FOREIGN KEY (struct_id) REFERENCES structure(id)
+            );
+
+            -- The PDB ids of blacklisted structures that have been deleted so
+            -- that they can be re-ingested.  These ids are blacklisted again
+            -- once the structures are back in the database, even if that
+            -- doesn't happen until a later update.
+            CREATE TABLE IF NOT EXISTS structure_blacklist_pending (
+                pdb_id STRING PRIMARY KEY
+            );
     ''')
 
     # Clusters:
@@ -174,6 +192,11 @@ def init_db(db):
                 FOREIGN KEY(entity_id) REFERENCES entity(id),
                 FOREIGN KEY(cluster_id) REFERENCES cluster(id)
             );
+
+            CREATE TABLE IF NOT EXISTS entity_branched_cluster_key (
+                bond_digest STRING PRIMARY KEY,
+                cluster_key STRING NOT NULL
+            );
     ''')
 
     # Components:
@@ -277,6 +300,17 @@ def init_db(db):
                 CHECK (clashscore >= 0),
                 FOREIGN KEY (struct_id) REFERENCES structure(id)
             );
+
+            -- Keep track of which sources of quality data have been ingested 
+            -- for each structure, even if those sources didn't end up 
+            -- providing any data.  This makes it possible to resume an 
+            -- interrupted ingestion without repeating any work.
+            CREATE TABLE IF NOT EXISTS quality_source (
+                struct_id INT NOT NULL,
+                source MMCIF_DICT NOT NULL,
+                UNIQUE (struct_id, source),
+                FOREIGN KEY (struct_id) REFERENCES structure(id)
+            );
     ''')
 
     # Redundancy:
@@ -308,8 +342,215 @@ def transaction(db):
         db.execute('COMMIT')
 
 
-def insert_structure(
-        db,
+def insert_structure(db, pdb_id, **kwargs):
+    """
+    Insert the given structure into the given database.
+
+    The main role of this function is to translate PDB id numbers to database 
+    primary key numbers.  The data frames provided to this function describe 
+    all the relationships between the models, assemblies, chains, subchains, 
+    and entities in the structure in terms of the id numbers used by the PDB.  
+    This function works out how to express all the same relationships using 
+    globally unique keys.
+
+    This function should be used within a transaction, since the database could 
+    end up in a corrupt state if a structure is only partially ingested.  
+    However, responsibility for transaction handling is left to the caller.
+
+    See `insert_structures()` for a description of the keyword arguments, and 
+    for a faster way to insert many structures at once.
+    """
+    struct_ids = insert_structures(db, [dict(pdb_id=pdb_id, **kwargs)])
+    return struct_ids[0]
+
+def insert_structures(db, structures):
+    """
+    Insert the given batch of structures into the given database.
+
+    Arguments:
+        structures:
+            A list of dictionaries, one for each structure.  Each dictionary 
+            should contain the following keys: *pdb_id*, *exptl_methods*, 
+            *deposit_date*, *full_atom*, *assemblies*, *assembly_subchains*, 
+            *subchains*, and *entities*.  The following keys are optional: 
+            *models*, *polymer_entities*, *branched_entities*, 
+            *branched_entity_bonds*, *monomer_entities*, *xtal_quality*, 
+            *nmr_representative*, and *em_quality*.
+
+    Returns:
+        A list of the primary keys assigned to each structure, in the same 
+        order as the given structures.
+
+    The end result is exactly the same as calling `insert_structure()` on each 
+    structure in turn, including the primary keys that are assigned.  The 
+    difference is that the primary keys for the whole batch are reserved up 
+    front, so each table can be filled by a single statement.  Like 
+    `insert_structure()`, transaction handling is left to the caller.
+    """
+    structures = [_prepare_structure(**x) for x in structures]
+
+    if not structures:
+        return []
+
+    def concat(key):
+        dfs = [
+                x[key].with_columns(struct_i=pl.lit(i, dtype=pl.Int64))
+                for i, x in enumerate(structures)
+                if x[key] is not None
+        ]
+        if not dfs:
+            return None
+
+        # Relax the dtypes, because data frames for different structures may 
+        # not agree on them.  For example, a column that's entirely null in one 
+        # structure might have a real dtype in another.
+        return pl.concat(dfs, how='diagonal_relaxed')
+
+    def reserve_ids(df, sequence, alias):
+        ids = _reserve_ids(db, sequence, len(df))
+        return df.with_columns(pl.Series(alias, ids))
+
+    def pdb_id_map(df, table):
+        return df.select(
+                'struct_i',
+                pl.col(f'{table}_id'),
+                pl.col('pdb_id').alias(f'pdb_{table}_id'),
+        )
+
+    ## Structures:
+
+    structs = reserve_ids(
+            pl.DataFrame(
+                [
+                    dict(
+                        struct_i=i,
+                        pdb_id=x['pdb_id'],
+                        exptl_methods=x['exptl_methods'],
+                        deposit_date=x['deposit_date'],
+                        full_atom=x['full_atom'],
+                    )
+                    for i, x in enumerate(structures)
+                ],
+                schema={
+                    'struct_i': pl.Int64,
+                    'pdb_id': str,
+                    'exptl_methods': pl.List(str),
+                    'deposit_date': pl.Date,
+                    'full_atom': bool,
+                },
+            ),
+            'structure_id', 'struct_id',
+    )
+    struct_ids = structs.select('struct_i', 'struct_id')
+    _insert_structures(db, structs)
+
+    def attach_struct_ids(df, sequence=None, alias=None):
+        if sequence:
+            df = reserve_ids(df, sequence, alias)
+        return df.join(struct_ids, on='struct_i')
+
+    ## Models, assemblies, chains, and entities:
+
+    # The order in which primary keys are reserved matters, because the goal 
+    # is to assign the same keys as would be assigned if each structure were 
+    # inserted individually.  The `concat()` function keeps the rows in order 
+    # of structure, then in the (sorted) order from `_prepare_structure()`, so 
+    # keys have to be reserved before any joins that could reorder the rows.
+
+    models = concat('models')
+    if models is not None:
+        models = attach_struct_ids(models, 'model_id', 'model_id')
+        _insert_models(db, models)
+        model_ids = pdb_id_map(models, 'model')
+
+    assemblies = attach_struct_ids(
+            concat('assemblies'), 'assembly_id', 'assembly_id',
+    )
+    _insert_assemblies(db, assemblies)
+    assembly_ids = pdb_id_map(assemblies, 'assembly')
+
+    chains = attach_struct_ids(concat('chains'), 'chain_id', 'chain_id')
+    _insert_chains(db, chains)
+    chain_ids = pdb_id_map(chains, 'chain')
+
+    entities = attach_struct_ids(concat('entities'), 'entity_id', 'entity_id')
+    _insert_entities(db, entities)
+    entity_ids = pdb_id_map(entities, 'entity')
+
+    ## Subchains:
+
+    subchains = (
+            reserve_ids(concat('subchains'), 'subchain_id', 'subchain_id')
+            .join(chain_ids, on=['struct_i', 'pdb_chain_id'])
+            .join(entity_ids, on=['struct_i', 'pdb_entity_id'])
+            .sort('subchain_id')
+    )
+    _insert_subchains(db, subchains)
+    subchain_ids = pdb_id_map(subchains, 'subchain')
+
+    assembly_subchains = (
+            concat('assembly_subchains')
+            .join(assembly_ids, on=['struct_i', 'pdb_assembly_id'])
+            .join(subchain_ids, on=['struct_i', 'pdb_subchain_id'])
+            .sort('assembly_id', 'subchain_id')
+    )
+    _insert_assembly_subchains(db, assembly_subchains)
+
+    ## Entity details:
+
+    def attach_entity_ids(key):
+        df = concat(key)
+        if df is None:
+            return None
+        return (
+                df
+                .join(entity_ids, on=['struct_i', 'pdb_entity_id'])
+                .sort('entity_id', maintain_order=True)
+        )
+
+    polymer_entities = attach_entity_ids('polymer_entities')
+    if polymer_entities is not None:
+        _insert_polymer_entities(db, polymer_entities)
+
+    branched_entities = attach_entity_ids('branched_entities')
+    if branched_entities is not None:
+        branched_entity_bonds = attach_entity_ids('branched_entity_bonds')
+        _insert_branched_entities(db, branched_entities, branched_entity_bonds)
+
+    monomer_entities = attach_entity_ids('monomer_entities')
+    if monomer_entities is not None:
+        _insert_monomer_entities(db, monomer_entities)
+
+    ## Quality metrics:
+
+    xtal_quality = concat('xtal_quality')
+    if xtal_quality is not None:
+        _insert_xtal_quality(db, attach_struct_ids(xtal_quality))
+
+    nmr_representatives = pl.DataFrame(
+            [
+                dict(struct_i=i, pdb_model_id=x['nmr_representative'])
+                for i, x in enumerate(structures)
+                if x['nmr_representative'] is not None
+            ],
+            schema={'struct_i': pl.Int64, 'pdb_model_id': str},
+    )
+    if not nmr_representatives.is_empty():
+        assert models is not None
+        _insert_nmr_representatives(
+                db,
+                nmr_representatives
+                .join(model_ids, on=['struct_i', 'pdb_model_id'])
+                .sort('model_id'),
+        )
+
+    em_quality = concat('em_quality')
+    if em_quality is not None:
+        _insert_em_quality(db, attach_struct_ids(em_quality))
+
+    return structs['struct_id'].to_list()
+
+def _prepare_structure(
         pdb_id,
         *,
         exptl_methods,
@@ -328,21 +569,6 @@ def insert_structure(
         nmr_representative=None,
         em_quality=None,
 ):
-    """
-    Insert the given structure into the given database.
-
-    The main role of this function is to translate PDB id numbers to database 
-    primary key numbers.  The data frames provided to this function describe 
-    all the relationships between the models, assemblies, chains, subchains, 
-    and entities in the structure in terms of the id numbers used by the PDB.  
-    This function works out how to express all the same relationships using 
-    globally unique keys.
-
-    This function should be used within a transaction, since the database could 
-    end up in a corrupt state if a structure is only partially ingested.  
-    However, responsibility for transaction handling is left to the caller.
-    """
-
     ## Rename id columns:
 
     # Switch to the column naming convention where `*_id` refers to an SQL 
@@ -412,104 +638,70 @@ def insert_structure(
     check_entity_ids(['branched'], branched_entity_bonds)
     check_entity_ids(['non-polymer', 'water'], monomer_entities)
 
-    ## Insert everything into the database:
+    if nmr_representative is not None:
+        assert models is not None
 
-    struct_id = _insert_structure(
-            db, pdb_id,
+    return dict(
+            pdb_id=pdb_id,
             exptl_methods=exptl_methods,
             deposit_date=deposit_date,
             full_atom=full_atom,
+            models=models,
+            assemblies=assemblies,
+            assembly_subchains=assembly_subchains,
+            chains=chains,
+            subchains=subchains,
+            entities=entities,
+            polymer_entities=polymer_entities,
+            branched_entities=branched_entities,
+            branched_entity_bonds=branched_entity_bonds,
+            monomer_entities=monomer_entities,
+            xtal_quality=xtal_quality,
+            nmr_representative=nmr_representative,
+            em_quality=em_quality,
     )
 
-    if models is not None:
-        model_ids = _insert_models(db, struct_id, models)
-
-    assembly_ids = _insert_assemblies(db, struct_id, assemblies)
-    chain_ids = _insert_chains(db, struct_id, chains)
-    entity_ids = _insert_entities(db, struct_id, entities)
-
-    subchains = (
-            subchains
-            .join(chain_ids, on='pdb_chain_id')
-            .join(entity_ids, on='pdb_entity_id')
-    )
-    subchain_ids = _insert_subchains(db, subchains)
-
-    assembly_subchains = (
-            assembly_subchains
-            .join(assembly_ids, on='pdb_assembly_id')
-            .join(subchain_ids, on='pdb_subchain_id')
-    )
-    _insert_assembly_subchains(db, assembly_subchains)
-
-    if polymer_entities is not None:
-        polymer_entities = (
-                polymer_entities
-                .join(entity_ids, on='pdb_entity_id')
-        )
-        _insert_polymer_entities(db, polymer_entities)
-
-    if branched_entities is not None:
-        branched_entities = (
-                branched_entities
-                .join(entity_ids, on='pdb_entity_id')
-        )
-        branched_entity_bonds = (
-                branched_entity_bonds
-                .join(entity_ids, on='pdb_entity_id')
-        )
-        _insert_branched_entities(db, branched_entities, branched_entity_bonds)
-
-    if monomer_entities is not None:
-        monomer_entities = (
-                monomer_entities
-                .join(entity_ids, on='pdb_entity_id')
-        )
-        _insert_monomer_entities(db, monomer_entities)
-
-    if xtal_quality is not None:
-        _insert_xtal_quality(db, struct_id, xtal_quality)
-
-    if nmr_representative is not None:
-        assert models is not None
-        model_id = (
-                model_ids
-                .filter(pl.col('pdb_model_id') == nmr_representative)
-                .select('model_id')
-                .item()
-        )
-        _insert_nmr_representative(db, model_id)
-
-    if em_quality is not None:
-        _insert_em_quality(db, struct_id, em_quality)
-
-    return struct_id
+def _reserve_ids(db, sequence, n):
+    # Primary keys are normally assigned by the `DEFAULT nextval(...)` clause 
+    # of each table.  Claiming them ahead of time makes it possible to work 
+    # out all the relationships between the rows being inserted in polars, 
+    # without needing a `RETURNING` round-trip for every table.
+    #
+    # Note that *n* is formatted directly into the query, rather than being 
+    # passed as a parameter, because DuckDB fails to recognize prepared 
+    # statements that call `nextval()` as writes (duckdb 1.1.3).
+    df = db.execute(
+            f"SELECT nextval('{sequence}') AS id FROM range({int(n)}) ORDER BY id",
+    ).pl()
+    return df['id']
 
-def _insert_structure(db, pdb_id, *, exptl_methods, deposit_date, full_atom):
-    cur = db.execute('''\
+def _insert_structures(db, structs):
+    db.execute('''\
             INSERT INTO structure (
+                id,
                 pdb_id,
                 exptl_methods,
                 deposit_date,
                 full_atom
             )
-            VALUES (?, ?, ?, ?)
-            RETURNING id''',
-            (pdb_id, exptl_methods, deposit_date, full_atom),
-    )
-    struct_id, = cur.fetchone()
-    return struct_id
+            SELECT
+                struct_id,
+                pdb_id,
+                exptl_methods,
+                deposit_date,
+                full_atom
+            FROM structs
+    ''')
 
-def _insert_models(db, struct_id, models):
-    return _insert_pdb_ids(db, 'model', struct_id, models)
+def _insert_models(db, models):
+    _insert_pdb_ids(db, 'model', models)
 
-def _insert_assemblies(db, struct_id, assemblies):
-    return db.execute('''\
-            INSERT INTO assembly (struct_id, pdb_id, type, polymer_count)
-            SELECT ?, pdb_id, type, polymer_count FROM assemblies
-            RETURNING id AS assembly_id, pdb_id AS pdb_assembly_id''',
-            [struct_id],
-    ).pl()
+def _insert_assemblies(db, assemblies):
+    db.execute('''\
+            INSERT INTO assembly (id, struct_id, pdb_id, type, polymer_count)
+            SELECT assembly_id, struct_id, pdb_id, type, polymer_count
+            FROM assemblies
+    ''')
 
 def _insert_assembly_subchains(db, assembly_subchains):
     db.execute('''\
@@ -517,22 +709,21 @@ def _insert_assembly_subchains(db, assembly_subchains):
             SELECT assembly_id, subchain_id FROM assembly_subchains
     ''')
 
-def _insert_chains(db, struct_id, chains):
-    return _insert_pdb_ids(db, 'chain', struct_id, chains)
+def _insert_chains(db, chains):
+    _insert_pdb_ids(db, 'chain', chains)
 
 def _insert_subchains(db, subchains):
-    return db.execute('''\
-            INSERT INTO subchain (chain_id, entity_id, pdb_id)
-            SELECT chain_id, entity_id, pdb_id from subchains
-            RETURNING id AS subchain_id, pdb_id AS pdb_subchain_id
-    ''').pl()
+    db.execute('''\
+            INSERT INTO subchain (id, chain_id, entity_id, pdb_id)
+            SELECT subchain_id, chain_id, entity_id, pdb_id from subchains
+    ''')
 
-def _insert_entities(db, struct_id, entities):
-    return db.execute('''\
-            INSERT INTO entity (struct_id, pdb_id, type, formula_weight_Da)
-            SELECT ?, pdb_id, type, formula_weight_Da from entities
-            RETURNING id AS entity_id, pdb_id AS pdb_entity_id
-    ''', [struct_id]).pl()
+def _insert_entities(db, entities):
+    db.execute('''\
+            INSERT INTO entity (id, struct_id, pdb_id, type, formula_weight_Da)
+            SELECT entity_id, struct_id, pdb_id, type, formula_weight_Da
+            FROM entities
+    ''')
 
 def _insert_polymer_entities(db, polymers):
     db.execute('''\
@@ -565,7 +756,7 @@ def _insert_monomer_entities(db, monomers):
             SELECT entity_id, comp_id FROM monomers
     ''')
 
-def _insert_xtal_quality(db, struct_id, quality_df):
+def _insert_xtal_quality(db, quality_df):
     db.execute('''\
             INSERT INTO quality_xtal (
                 struct_id,
@@ -575,21 +766,21 @@ def _insert_xtal_quality(db, struct_id, quality_df):
                 r_free
             )
             SELECT
-                ?,
+                struct_id,
                 'mmcif_pdbx',
                 resolution_A,
                 r_work,
                 r_free
             FROM quality_df
-    ''', [struct_id])
+    ''')
 
-def _insert_nmr_representative(db, model_id):
+def _insert_nmr_representatives(db, representatives):
     db.execute('''\
             INSERT INTO quality_nmr_representative (model_id, source)
-            VALUES (?, 'mmcif_pdbx')
-    ''', [model_id])
+            SELECT model_id, 'mmcif_pdbx' FROM representatives
+    ''')
 
-def _insert_em_quality(db, struct_id, quality_df):
+def _insert_em_quality(db, quality_df):
     db.execute('''\
             INSERT INTO quality_em (
                 struct_id,
@@ -597,27 +788,150 @@ def _insert_em_quality(db, struct_id, quality_df):
                 resolution_A
             )
             SELECT
-                ?,
+                struct_id,
                 'mmcif_pdbx',
                 resolution_A
             FROM quality_df
-    ''', [struct_id])
-
-def _insert_pdb_ids(db, table, struct_id, pdb_ids):
-    return db.execute(f'''\
-            INSERT INTO {table} (struct_id, pdb_id)
-            SELECT ?, pdb_id FROM pdb_ids
-            RETURNING id AS {table}_id, pdb_id AS pdb_{table}_id''',
-            [struct_id],
-    ).pl()
+    ''')
+
+def _insert_pdb_ids(db, table, pdb_ids):
+    db.execute(f'''\
+            INSERT INTO {table} (id, struct_id, pdb_id)
+            SELECT {table}_id, struct_id, pdb_id FROM pdb_ids
+    ''')
+
+def insert_structure_files(db, files):
+    """
+    Arguments:
+        files:
+            A dataframe with columns *struct_id*, *size_bytes*, and 
+            *mtime_ns*.  The latter two should come from `os.stat()`.
+    """
+    db.execute('''\
+            INSERT INTO structure_file (struct_id, size_bytes, mtime_ns)
+            SELECT struct_id, size_bytes, mtime_ns FROM files
+    ''')
+
+def delete_structures(db, struct_ids):
+    """
+    Delete the given structures, and every row that refers to them, from the 
+    given database.
+
+    This includes rows in tables that are derived from the structures (e.g. 
+    ranks, clusters, non-redundant subchains), so those tables may need to be 
+    regenerated afterwards.
+
+    DuckDB checks foreign key constraints against the state of the database 
+    at the start of the current transaction, so it's not possible to delete 
+    rows and the rows they refer to in a single transaction.  Instead, each 
+    level of the hierarchy is deleted in its own transaction, starting with 
+    the rows that nothing else refers to.  If this function is interrupted, 
+    it's safe to simply call it again.  This also means that this function 
+    cannot be called from within a transaction.
+    """
+    doomed = pl.DataFrame({'struct_id': list(struct_ids)}, {'struct_id': int})
+    if doomed.is_empty():
+        return
+
+    db.execute('''\
+            CREATE OR REPLACE TEMPORARY TABLE doomed_structure AS
+            SELECT struct_id AS id FROM doomed;
+
+            CREATE OR REPLACE TEMPORARY TABLE doomed_model AS
+            SELECT id FROM model
+            WHERE struct_id IN (SELECT id FROM doomed_structure);
+
+            CREATE OR REPLACE TEMPORARY TABLE doomed_assembly AS
+            SELECT id FROM assembly
+            WHERE struct_id IN (SELECT id FROM doomed_structure);
+
+            CREATE OR REPLACE TEMPORARY TABLE doomed_entity AS
+            SELECT id FROM entity
+            WHERE struct_id IN (SELECT id FROM doomed_structure);
+
+            CREATE OR REPLACE TEMPORARY TABLE doomed_subchain AS
+            SELECT id FROM subchain
+            WHERE entity_id IN (SELECT id FROM doomed_entity);
+    ''')
+
+    # Each table maps to the columns that should be checked against each list 
+    # of doomed primary keys.
+    levels = [
+            {
+                'quality_nmr_representative': {'model_id': 'model'},
+                'assembly_rank': {'assembly_id': 'assembly'},
+                'assembly_subchain': {'assembly_id': 'assembly'},
+                'nonredundant': {'subchain_id': 'subchain'},
+                'nonredundant_pair': {
+                    'subchain_id_1': 'subchain',
+                    'subchain_id_2': 'subchain',
+                },
+                'entity_polymer': {'entity_id': 'entity'},
+                'entity_branched': {'entity_id': 'entity'},
+                'entity_branched_bond': {'entity_id': 'entity'},
+                'entity_monomer': {'entity_id': 'entity'},
+                'entity_ignore': {'entity_id': 'entity'},
+                'entity_cluster': {'entity_id': 'entity'},
+                'quality_xtal': {'struct_id': 'structure'},
+                'quality_nmr': {'struct_id': 'structure'},
+                'quality_em': {'struct_id': 'structure'},
+                'quality_clashscore': {'struct_id': 'structure'},
+                'quality_source': {'struct_id': 'structure'},
+                'structure_blacklist': {'struct_id': 'structure'},
+            },
+            {
+                'subchain': {'id': 'subchain'},
+                'model': {'id': 'model'},
+            },
+            {
+                'assembly': {'id': 'assembly'},
+                'chain': {'struct_id': 'structure'},
+                'entity': {'id': 'entity'},
+            },
+            {
+                'structure_file': {'struct_id': 'structure'},
+            },
+            {
+                'structure': {'id': 'structure'},
+            },
+    ]
+
+    for level in levels:
+        with transaction(db):
+            for table, cols in level.items():
+                where = ' OR '.join(
+                        f'{col} IN (SELECT id FROM doomed_{doomed})'
+                        for col, doomed in cols.items()
+                )
+                db.execute(f'DELETE FROM {table} WHERE {where}')
+
+    db.execute('''\
+            DROP TABLE doomed_structure;
+            DROP TABLE doomed_model;
+            DROP TABLE doomed_assembly;
+            DROP TABLE doomed_entity;
+            DROP TABLE doomed_subchain;
+    ''')
 
 def update_structure_ranks(db, ranks):
-    db.sql('''\
+    """
+    Arguments:
+        ranks:
+            A dataframe (or DuckDB relation) with columns *struct_id* and 
+            *rank*.  Only the structures whose rank actually changes are 
+            updated, so rerunning after a handful of new structures have been 
+            added only writes the ranks that those structures displaced.
+
+    Returns:
+        The number of structures whose rank was updated.
+    """
+    return db.execute('''\
             UPDATE structure
             SET rank = ranks.rank
             FROM ranks
             WHERE structure.id = ranks.struct_id
-    ''')
+            AND structure.rank IS DISTINCT FROM ranks.rank
+    ''').fetchone()[0]
 
 def insert_blacklisted_structures(db, blacklist):
     db.execute('''\
@@ -627,6 +941,47 @@ def insert_blacklisted_structures(db, blacklist):
             JOIN structure USING (pdb_id)
     ''')
 
+def insert_pending_blacklisted_structures(db, struct_ids):
+    """
+    Remember which of the given structures are blacklisted, so that they can 
+    be blacklisted again (by `restore_blacklisted_structures()`) after being 
+    deleted and re-ingested.
+    """
+    struct_ids = pl.DataFrame(
+            {'struct_id': struct_ids},
+            {'struct_id': int},
+    )
+    db.execute('''\
+            INSERT OR IGNORE INTO structure_blacklist_pending (pdb_id)
+            SELECT DISTINCT structure.pdb_id
+            FROM structure_blacklist
+            JOIN structure ON structure.id = structure_blacklist.struct_id
+            SEMI JOIN struct_ids
+            ON structure_blacklist.struct_id = struct_ids.struct_id
+    ''')
+
+def restore_blacklisted_structures(db):
+    """
+    Blacklist any pending structures that are back in the database.  Pending 
+    structures that still aren't in the database remain pending.
+    """
+    with transaction(db):
+        db.execute('''\
+                INSERT INTO structure_blacklist (struct_id)
+                SELECT structure.id
+                FROM structure_blacklist_pending
+                JOIN structure USING (pdb_id)
+                ANTI JOIN structure_blacklist
+                ON structure.id = structure_blacklist.struct_id
+        ''')
+        db.execute('''\
+                DELETE FROM structure_blacklist_pending
+                WHERE pdb_id IN (SELECT pdb_id FROM structure)
+        ''')
+
+def select_pending_blacklisted_structures(db):
+    return db.execute('SELECT * FROM structure_blacklist_pending').pl()
+
 def insert_assembly_ranks(db, ranks):
     """
     Arguments:
@@ -645,22 +1000,90 @@ def insert_assembly_ranks(db, ranks):
     ''')
 
 def insert_nmr_quality(db, struct_id, *, source, num_dist_restraints=None):
+    quality = _make_quality_df(
+            struct_id=(struct_id, int),
+            source=(source, str),
+            num_dist_restraints=(num_dist_restraints, int),
+    )
+    insert_nmr_qualities(db, quality)
+
+def insert_nmr_qualities(db, quality):
+    """
+    Arguments:
+        quality:
+            A dataframe with columns *struct_id*, *source*, and 
+            *num_dist_restraints*.
+    """
     db.execute('''\
             INSERT INTO quality_nmr (struct_id, source, num_dist_restraints)
-            VALUES (?, ?, ?)
-    ''', [struct_id, source, num_dist_restraints])
+            SELECT struct_id, source, num_dist_restraints FROM quality
+    ''')
 
 def insert_em_quality(db, struct_id, *, source, resolution_A=None, q_score=None):
+    quality = _make_quality_df(
+            struct_id=(struct_id, int),
+            source=(source, str),
+            resolution_A=(resolution_A, float),
+            q_score=(q_score, float),
+    )
+    insert_em_qualities(db, quality)
+
+def insert_em_qualities(db, quality):
+    """
+    Arguments:
+        quality:
+            A dataframe with columns *struct_id*, *source*, *resolution_A*, 
+            and *q_score*.
+    """
     db.execute('''\
             INSERT INTO quality_em (struct_id, source, resolution_A, q_score)
-            VALUES (?, ?, ?, ?)
-    ''', (struct_id, source, resolution_A, q_score))
+            SELECT struct_id, source, resolution_A, q_score FROM quality
+    ''')
 
 def insert_clashscore(db, struct_id, *, source, clashscore):
+    quality = _make_quality_df(
+            struct_id=(struct_id, int),
+            source=(source, str),
+            clashscore=(clashscore, float),
+    )
+    insert_clashscores(db, quality)
+
+def insert_clashscores(db, quality):
+    """
+    Arguments:
+        quality:
+            A dataframe with columns *struct_id*, *source*, and *clashscore*.
+    """
     db.execute('''\
             INSERT INTO quality_clashscore (struct_id, source, clashscore)
-            VALUES (?, ?, ?)
-    ''', (struct_id, source, clashscore))
+            SELECT struct_id, source, clashscore FROM quality
+    ''')
+
+def insert_quality_source(db, struct_id, *, source):
+    quality = _make_quality_df(
+            struct_id=(struct_id, int),
+            source=(source, str),
+    )
+    insert_quality_sources(db, quality)
+
+def insert_quality_sources(db, sources):
+    """
+    Arguments:
+        sources:
+            A dataframe with columns *struct_id* and *source*.
+    """
+    db.execute('''\
+            INSERT INTO quality_source (struct_id, source)
+            SELECT struct_id, source FROM sources
+    ''')
+
+def _make_quality_df(**cols):
+    # Specify the data types explicitly, so that missing values don't end up 
+    # as columns of type `Null`.
+    return pl.DataFrame(
+            {k: [v] for k, (v, _) in cols.items()},
+            schema={k: dtype for k, (_, dtype) in cols.items()},
+    )
 
 def insert_nonspecific_ligands(db, ignore):
     db.sql('''\
@@ -706,6 +1129,21 @@ def insert_entity_clusters(db, clusters, namespace):
             SELECT entity_id, cluster_id FROM cluster_edges
     ''')
 
+def insert_branched_entity_cluster_keys(db, keys):
+    """
+    Arguments:
+        keys:
+            A dataframe with columns *bond_digest* and *cluster_key*, as 
+            described in `select_branched_entity_bond_digests()`.  Digests that 
+            are already in the database are ignored.
+    """
+    db.sql('''\
+            INSERT OR IGNORE INTO entity_branched_cluster_key (
+                bond_digest, cluster_key
+            )
+            SELECT DISTINCT bond_digest, cluster_key FROM keys
+    ''')
+
 def insert_chemical_components(db, components):
     db.sql('''\
             INSERT INTO component (pdb_id, inchi, inchi_key)
@@ -727,6 +1165,9 @@ def select_structure_id(db, pdb_id):
     cur = db.execute('SELECT id FROM structure WHERE pdb_id = ?', (pdb_id,))
     return cur.fetchone()[0]
 
+def select_structure_files(db):
+    return db.execute('SELECT * FROM structure_file').pl()
+
 def select_blacklisted_structures(db):
     return db.execute('SELECT * FROM structure_blacklist').pl()
 
@@ -766,6 +1207,46 @@ def select_branched_entities(db):
 def select_branched_entity_bonds(db):
     return db.execute('SELECT * FROM entity_branched_bond').pl()
 
+def select_branched_entity_bond_digests(db):
+    """
+    Return a digest of the bonds in each branched entity.
+
+    The digest is calculated from the sorted list of bonds, so it doesn't 
+    depend on the order in which the bonds were inserted.  The resulting 
+    dataframe also includes a *cluster_key* column, which is taken from the 
+    *entity_branched_cluster_key* table if a key has already been recorded for 
+    the same digest, and is null otherwise.
+    """
+    return db.execute('''\
+            SELECT
+                digest.entity_id,
+                digest.bond_digest,
+                cluster_key.cluster_key
+            FROM (
+                SELECT
+                    entity_id,
+                    sha256(to_json(list(
+                        [
+                            pdb_seq_id_1, pdb_comp_id_1, pdb_atom_id_1,
+                            pdb_seq_id_2, pdb_comp_id_2, pdb_atom_id_2,
+                            bond_order,
+                        ]
+                        ORDER BY
+                            pdb_seq_id_1, pdb_comp_id_1, pdb_atom_id_1,
+                            pdb_seq_id_2, pdb_comp_id_2, pdb_atom_id_2,
+                            bond_order
+                    ))) AS bond_digest
+                FROM entity_branched_bond
+                GROUP BY entity_id
+            ) AS digest
+            LEFT JOIN entity_branched_cluster_key AS cluster_key
+            USING (bond_digest)
+            ORDER BY digest.entity_id
+    ''').pl()
+
+def select_branched_entity_cluster_keys(db):
+    return db.execute('SELECT * FROM entity_branched_cluster_key').pl()
+
 def select_monomer_entities(db):
     return db.execute('SELECT * FROM entity_monomer').pl()
 
@@ -790,6 +1271,9 @@ def select_em_quality(db):
 def select_clashscores(db):
     return db.execute('SELECT * FROM quality_clashscore').pl()
 
+def select_quality_sources(db):
+    return db.execute('SELECT * FROM quality_source').pl()
+
 def select_nonredundant_subchains(db):
     return db.execute('SELECT * FROM nonredundant').pl()
 
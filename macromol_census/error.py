@@ -1,5 +1,7 @@
 from tidyexc import Error
 from contextlib import contextmanager
+from dataclasses import dataclass
+from more_itertools import one
 
 class UsageError(Error):
     pass
@@ -19,3 +21,75 @@ def add_path_to_ingest_error(path):
         except Exception as err:
             summary = str(err).split('\n')[0]
             raise IngestError(summary) from err
+
+def insert_batch_and_blame_path(insert, batch):
+    """
+    Insert a batch of parsed files, and if that fails, find out which file was 
+    responsible.
+
+    Arguments:
+        insert:
+            A callable that inserts a list of items into the database in a 
+            single transaction, such that nothing is inserted if an exception 
+            is raised.
+
+        batch:
+            A list of ``(path, data)`` tuples, where *path* is the file that 
+            *data* was parsed from.
+
+    If the whole batch can't be inserted, the items are retried one at a time.  
+    An error is only raised if one of those individual inserts fails, and in 
+    that case the error will include the path of the offending file.
+    """
+    if len(batch) == 1:
+        path, _ = one(batch)
+        with add_path_to_ingest_error(path):
+            insert(batch)
+        return
+
+    try:
+        insert(batch)
+
+    except Exception:
+        # The whole batch has been rolled back at this point, so it's not clear 
+        # which item was responsible.  Insert the items one at a time to find 
+        # out.  If none of them fail, then everything has been inserted and 
+        # there's nothing left to report.
+        for item in batch:
+            insert_batch_and_blame_path(insert, [item])
+
+@dataclass(frozen=True)
+class IngestFailure:
+    """
+    A picklable record of an `IngestError`.
+
+    Exceptions derived from `tidyexc.Error` don't survive being pickled, which 
+    makes them impossible to send back from worker processes.  This class 
+    stores the fully-formatted messages instead, and can rebuild an equivalent 
+    exception in the parent process.
+    """
+    brief: str
+    info: tuple[str, ...] = ()
+    blame: tuple[str, ...] = ()
+    hints: tuple[str, ...] = ()
+
+    @classmethod
+    def from_error(cls, err):
+        return cls(
+                brief=err.brief_str,
+                info=tuple(err.info_strs),
+                blame=tuple(err.blame_strs),
+                hints=tuple(err.hint_strs),
+        )
+
+    def to_error(self):
+        # The messages have already been formatted, so escape any braces to 
+        # keep them from being interpreted as template parameters again.
+        def escape(s):
+            return s.replace('{', '{{').replace('}', '}}')
+
+        err = IngestError(escape(self.brief))
+        err.info += [escape(x) for x in self.info]
+        err.blame += [escape(x) for x in self.blame]
+        err.hints += [escape(x) for x in self.hints]
+        return err
@@ -2,7 +2,16 @@
 Cluster branched entities by identity.
 
 Usage:
-    mmc_find_identical_branched_entities <in:db>
+    mmc_find_identical_branched_entities <in:db> [-j <int>]
+
+Arguments:
+    <in:db>
+        The path to a database created by the `mmc_ingest_mmcif` command.
+
+Options:
+    -j --jobs <int>  [default: 1]
+        The number of processes to use when comparing entities.  The resulting 
+        clusters don't depend on the number of processes.
 
 The PDB defines three kinds of molecular entities: polymer, non-polymer, and 
 branched [1].  Branched entities, those where each monomer can be bonded to 
@@ -18,8 +27,11 @@ comparisons is an example of the graph isomorphism problem.
 
 This script identifies every group of identical branched entities in the PDB.  
 It does so by (i) creating a graph representing each branched entity, (ii) 
-hashing the graph to find groups of potentially identical entities, and (iii) 
-solving the graph isomorphism problem within each group.
+converting each graph into a canonical string, and (iii) grouping entities 
+with the same canonical string.  Almost every branched entity is a tree, and 
+trees have simple canonical forms (e.g. the AHU algorithm).  The few entities 
+that contain cycles are instead hashed, and then compared by solving the graph 
+isomorphism problem within each group of identical hashes.
 
 Note that this script does not make any attempt to group "similar" entities, 
 like a sequence alignment does.  This is mostly because there aren't enough 
@@ -31,13 +43,18 @@ grouped together.
 """
 
 import polars as pl
+import numpy as np
 import networkx as nx
 import operator as op
 
 from .database_io import (
-        open_db, select_branched_entity_bonds, insert_entity_clusters,
+        open_db,
+        select_branched_entity_bonds, select_branched_entity_bond_digests,
+        insert_branched_entity_cluster_keys, insert_entity_clusters,
 )
 from collections import defaultdict
+from contextlib import nullcontext
+from hashlib import sha256
 from tqdm import tqdm
 
 def main():
@@ -46,78 +63,513 @@ def main():
 
     db = open_db(args['<in:db>'])
 
-    clusters = find_identical_branched_entities(db)
+    clusters = find_identical_branched_entities(db, jobs=int(args['--jobs']))
     insert_entity_clusters(db, clusters, 'identical-branched-entities')
 
-def find_identical_branched_entities(db):
-    entities = []
-    bonds = select_branched_entity_bonds(db)
-    n = db.sql('''\
-            SELECT count(*)
-            FROM entity
-            WHERE type = 'branched'
-    ''').pl().item()
-
-    for (entity_id,), bonds_i in tqdm(
-            bonds.group_by(['entity_id']),
-            desc='finding branched entities',
-            total=n,
-    ):
-        g = nx.Graph(entity_id=entity_id)
+def find_identical_branched_entities(db, jobs=1):
+    """
+    Cluster the branched entities in the given database by identity.
+
+    The cluster key calculated for each entity is recorded in the database, 
+    indexed by a digest of the entity's bonds.  Entities with a digest that 
+    has been seen before (e.g. in a previous run) reuse the recorded key, and 
+    don't need to be converted into graphs or canonicalized again.  Entities 
+    that contain cycles don't have cluster keys, and are always compared from 
+    scratch.
+    """
+    digests = select_branched_entity_bond_digests(db)
+    known_digests = digests.filter(pl.col('cluster_key').is_not_null())
+    new_digests = digests.filter(pl.col('cluster_key').is_null())
+
+    bonds = (
+            select_branched_entity_bonds(db)
+            .join(new_digests, on='entity_id', how='semi')
+    )
+    new_entity_ids, new_graphs = _make_labeled_graphs(bonds)
+    new_graphs = list(new_graphs)
 
-        for row in bonds_i.iter_rows(named=True):
-            comp_1 = row['pdb_seq_id_1']
-            atom_1 = (comp_1, row['pdb_atom_id_1'])
-            comp_2 = row['pdb_seq_id_2']
-            atom_2 = (comp_2, row['pdb_atom_id_2'])
+    with _make_pool(jobs) as pool:
+        new_hashes = _hash_labeled_graphs(new_graphs, pool)
 
-            g.add_node(comp_1, label=row['pdb_comp_id_1'])
-            g.add_node(comp_2, label=row['pdb_comp_id_2'])
-            g.add_node(atom_1, label=atom_1)
-            g.add_node(atom_2, label=atom_1)
+        new_keys = (
+                pl.DataFrame(
+                    {
+                        'entity_id': new_entity_ids,
+                        'cluster_key': [k for k, _ in new_hashes],
+                        'is_canonical': [x for _, x in new_hashes],
+                        'graph_i': range(len(new_graphs)),
+                    },
+                    schema_overrides={
+                        'cluster_key': pl.String,
+                        'is_canonical': pl.Boolean,
+                    },
+                )
+                .join(new_digests.drop('cluster_key'), on='entity_id')
+        )
+        insert_branched_entity_cluster_keys(
+                db, new_keys.filter('is_canonical'),
+        )
 
-            g.add_edge(comp_1, atom_1, label=None)
-            g.add_edge(atom_1, atom_2, label=row['bond_order'])
-            g.add_edge(atom_2, comp_2, label=None)
+        keys = (
+                pl.concat(
+                    [
+                        known_digests.with_columns(
+                            is_canonical=True,
+                            graph_i=None,
+                        ),
+                        new_keys,
+                    ],
+                    how='diagonal_relaxed',
+                )
+                .sort('entity_id')
+        )
+        hashes = list(keys.select('cluster_key', 'is_canonical').iter_rows())
+        graphs = [
+                None if i is None else new_graphs[i]
+                for i in keys['graph_i']
+        ]
+        cluster_ids = _cluster_hashes(hashes, graphs, pool)
 
-        entities.append(g)
+    return (
+            pl.DataFrame({
+                'entity_id': keys['entity_id'],
+                'cluster_id': pl.Series(cluster_ids, dtype=pl.Int64),
+            })
+            .sort('cluster_id', maintain_order=True)
+    )
 
-    return cluster_isomorphic_graphs(entities)
+def cluster_isomorphic_graphs(graphs, jobs=1):
+    graphs = list(graphs)
+    cluster_ids = _cluster_labeled_graphs(
+            map(_labeled_graph_from_nx, graphs),
+            jobs,
+    )
+    rows = [
+            {**g.graph, 'cluster_id': cluster_id}
+            for g, cluster_id in zip(graphs, cluster_ids)
+    ]
+    return pl.DataFrame(rows).sort('cluster_id', maintain_order=True)
 
-def cluster_isomorphic_graphs(graphs):
-    candidate_groups = defaultdict(list)
+def canonicalize_labeled_tree(g):
+    """
+    Return a string that uniquely identifies the given graph, up to 
+    isomorphism.
+
+    Arguments:
+        g:
+            A `networkx.Graph`.  Each node and edge can have a ``label`` 
+            attribute, which is taken into account when comparing graphs.  
+            Labels are compared by their `repr()`.
 
-    for g in tqdm(graphs, desc='computing graph hashes'):
-        hash_ = nx.weisfeiler_lehman_graph_hash(
-                g,
-                node_attr='label',
-                edge_attr='label',
+    Returns:
+        A string, if the graph is a tree (or a forest).  Any two trees that are 
+        isomorphic, including labels, will have the same string, and any two 
+        that aren't will have different strings.  If the graph contains a 
+        cycle, None is returned instead.
+    """
+    return _canonicalize_forest(*_labeled_graph_from_nx(g))
+
+def _make_labeled_graphs(bonds):
+    """
+    Convert the given bonds into one graph per branched entity.
+
+    Each graph is a tuple of node labels and edges, where each edge is a tuple 
+    of two node indices and an edge label.  All labels are reprs, so these 
+    graphs are the same as those that `_labeled_graph_from_nx()` would create 
+    from the networkx graphs used by `cluster_isomorphic_graphs()`.  The 
+    graphs have a node for each monomer (labeled by component id) and a node 
+    for each bonded atom (labeled by component and atom id).  Each atom node 
+    is connected to its monomer, and bonded atom nodes are connected to each 
+    other (labeled by bond order).
+
+    Building the graphs is done for all of the entities at once, using 
+    dataframe operations.  Only slicing the resulting arrays into individual 
+    graphs is done in python.
+    """
+    ends = pl.concat([
+        bonds.select(
+            'entity_id',
+            seq_id=f'pdb_seq_id_{i}',
+            comp_id=f'pdb_comp_id_{i}',
+            atom_id=f'pdb_atom_id_{i}',
         )
-        candidate_groups[hash_].append(g)
+        for i in (1, 2)
+    ])
+    monomers = (
+            ends
+            .unique(['entity_id', 'seq_id'], keep='first', maintain_order=True)
+            .with_columns(atom_id=pl.lit(None, pl.String))
+    )
+    atoms = (
+            ends
+            .unique(
+                ['entity_id', 'seq_id', 'atom_id'],
+                keep='first',
+                maintain_order=True,
+            )
+    )
+    nodes = (
+            pl.concat([monomers, atoms])
+            .sort('entity_id', maintain_order=True)
+            .with_row_index('node_i')
+    )
+
+    # Labels have to be reprs, so that they can't be confused with the 
+    # punctuation in the canonical strings.  There are relatively few distinct 
+    # labels, so only calculate each repr once.
+    distinct_labels = nodes.select('comp_id', 'atom_id').unique()
+    distinct_labels = distinct_labels.with_columns(
+            label=pl.Series([
+                repr(comp_id) if atom_id is None else repr((comp_id, atom_id))
+                for comp_id, atom_id in distinct_labels.iter_rows()
+            ], dtype=pl.String),
+    )
+    nodes = (
+            nodes
+            .join(
+                distinct_labels,
+                on=['comp_id', 'atom_id'],
+                how='left',
+                join_nulls=True,
+            )
+            .sort('node_i')
+    )
+
+    monomer_nodes = (
+            nodes
+            .filter(pl.col('atom_id').is_null())
+            .select('entity_id', 'seq_id', monomer_i='node_i')
+    )
+    atom_nodes = (
+            nodes
+            .filter(pl.col('atom_id').is_not_null())
+            .select('entity_id', 'seq_id', 'atom_id', atom_i='node_i')
+    )
+
+    monomer_atom_edges = (
+            atom_nodes
+            .join(monomer_nodes, on=['entity_id', 'seq_id'])
+            .select(
+                'entity_id',
+                node_i='monomer_i',
+                node_j='atom_i',
+                label=pl.lit(repr(None)),
+            )
+    )
+
+    # As with the node labels, there are only a handful of distinct bond 
+    # orders, so only calculate each repr once.
+    distinct_bond_orders = bonds.select('bond_order').unique()
+    distinct_bond_orders = distinct_bond_orders.with_columns(
+            label=pl.Series([
+                repr(bond_order)
+                for bond_order in distinct_bond_orders['bond_order']
+            ], dtype=pl.String),
+    )
+    atom_atom_edges = (
+            bonds
+            .join(
+                distinct_bond_orders,
+                on='bond_order',
+                how='left',
+                join_nulls=True,
+            )
+            .join(
+                atom_nodes.rename({'atom_i': 'node_i'}),
+                left_on=['entity_id', 'pdb_seq_id_1', 'pdb_atom_id_1'],
+                right_on=['entity_id', 'seq_id', 'atom_id'],
+            )
+            .join(
+                atom_nodes.rename({'atom_i': 'node_j'}),
+                left_on=['entity_id', 'pdb_seq_id_2', 'pdb_atom_id_2'],
+                right_on=['entity_id', 'seq_id', 'atom_id'],
+            )
+            .select(
+                'entity_id',
+                'node_i',
+                'node_j',
+                'label',
+            )
+    )
+    edges = (
+            pl.concat([monomer_atom_edges, atom_atom_edges])
+
+            # Like networkx, keep only the last label given to any edge.
+            .with_columns(
+                edge=pl.concat_list(
+                    pl.min_horizontal('node_i', 'node_j'),
+                    pl.max_horizontal('node_i', 'node_j'),
+                ),
+            )
+            .unique('edge', keep='last', maintain_order=True)
+            .sort('entity_id', maintain_order=True)
+    )
+
+    # Each entity's nodes and edges are contiguous, so the graphs are just 
+    # slices of these arrays:
+    entity_ids = nodes['entity_id'].unique(maintain_order=True).to_numpy()
+    node_offsets = _find_offsets(nodes['entity_id'].to_numpy(), entity_ids)
+    edge_offsets = _find_offsets(edges['entity_id'].to_numpy(), entity_ids)
+
+    node_labels = nodes['label'].to_list()
+    edge_i = edges['node_i'].to_numpy()
+    edge_j = edges['node_j'].to_numpy()
+    edge_labels = edges['label'].to_list()
+
+    def iter_graphs():
+        for k in range(len(entity_ids)):
+            n0, n1 = node_offsets[k:k+2]
+            e0, e1 = edge_offsets[k:k+2]
+
+            labels = node_labels[n0:n1]
+            edges = list(zip(
+                    (edge_i[e0:e1] - n0).tolist(),
+                    (edge_j[e0:e1] - n0).tolist(),
+                    edge_labels[e0:e1],
+            ))
+            yield labels, edges
+
+    return entity_ids, iter_graphs()
+
+def _find_offsets(sorted_ids, unique_ids):
+    offsets = np.searchsorted(sorted_ids, unique_ids, side='left')
+    return np.append(offsets, len(sorted_ids))
+
+def _labeled_graph_from_nx(g):
+    index = {v: i for i, v in enumerate(g.nodes)}
+    labels = [repr(label) for _, label in g.nodes(data='label')]
+    edges = [
+            (index[u], index[v], repr(label))
+            for u, v, label in g.edges(data='label')
+    ]
+    return labels, edges
+
+def _nx_from_labeled_graph(labels, edges):
+    g = nx.Graph()
+
+    for i, label in enumerate(labels):
+        g.add_node(i, label=label)
+    for i, j, label in edges:
+        g.add_edge(i, j, label=label)
+
+    return g
+
+def _cluster_labeled_graphs(graphs, jobs=1):
+    """
+    Assign the same cluster id to every isomorphic graph.
+
+    Arguments:
+        graphs:
+            An iterable of graphs, in the format returned by 
+            `_make_labeled_graphs()`.
+
+        jobs:
+            The number of processes to use.  The cluster ids don't depend on 
+            the number of processes.
+
+    Returns:
+        A list of cluster ids, one for each graph.  Cluster ids are assigned in 
+        order of first appearance, starting from 1.
+    """
+    graphs = list(graphs)
+
+    with _make_pool(jobs) as pool:
+        hashes = _hash_labeled_graphs(graphs, pool)
+        return _cluster_hashes(hashes, graphs, pool)
+
+def _hash_labeled_graphs(graphs, pool):
+    # Each graph is small, so send them to the workers in big chunks.
+    hashes = _imap(pool, _hash_labeled_graph, graphs, chunksize=256)
+    return list(tqdm(hashes, desc='canonicalizing graphs', total=len(graphs)))
+
+def _hash_labeled_graph(graph):
+    # Return a digest of the canonical form, rather than the canonical form 
+    # itself, because the digests are smaller to send between processes and to 
+    # store in the database.
+    form = _canonicalize_forest(*graph)
+    if form is not None:
+        return sha256(form.encode()).hexdigest(), True
+
+    hash_ = nx.weisfeiler_lehman_graph_hash(
+            _nx_from_labeled_graph(*graph),
+            node_attr='label',
+            edge_attr='label',
+    )
+    return hash_, False
+
+def _cluster_hashes(hashes, graphs, pool):
+    """
+    Arguments:
+        hashes:
+            A list of ``(key, is_canonical)`` tuples, as returned by 
+            `_hash_labeled_graph()`.
+
+        graphs:
+            A list of graphs, in the same order as *hashes*.  Only the graphs 
+            that don't have canonical keys are needed; the others can be None.
 
-    rows = []
-    cursor = 1
+        pool:
+            A process pool, or None to do everything in this process.
+    """
+    groups = defaultdict(list)
+    candidate_groups = defaultdict(list)
+
+    # Graphs that aren't trees don't have canonical keys, so fall back to 
+    # checking for isomorphisms within each bucket of identical hashes.  These 
+    # graphs are rare, so the buckets are small.
+
+    for i, (key, is_canonical) in enumerate(hashes):
+        if is_canonical:
+            groups[key].append(i)
+        else:
+            candidate_groups[key].append(i)
 
-    for candidate_group in tqdm(
-            candidate_groups.values(),
-            desc='computing graph isomorphisms',
+    buckets = [
+            [graphs[i] for i in candidate_group]
+            for candidate_group in candidate_groups.values()
+    ]
+    subgroups = _imap(pool, _split_isomorphic_graphs, buckets)
+
+    for (hash_, candidate_group), confirmed_groups in zip(
+            candidate_groups.items(),
+            tqdm(
+                subgroups,
+                desc='computing graph isomorphisms',
+                total=len(buckets),
+            ),
     ):
-        confirmed_groups = []
-
-        for g in candidate_group:
-            for subgroup in confirmed_groups:
-                if nx.is_isomorphic(g, subgroup[0], op.eq, op.eq):
-                    subgroup.append(g)
-                    break
-            else:
-                confirmed_groups.append([g])
-
-        for confirmed_group in confirmed_groups:
-            for g in confirmed_group:
-                rows.append({
-                    **g.graph,
-                    'cluster_id': cursor,
-                })
-            cursor += 1
-
-    return pl.DataFrame(rows)
+        for j, confirmed_group in enumerate(confirmed_groups):
+            groups[hash_, j] = [candidate_group[k] for k in confirmed_group]
+
+    # Number the clusters in order of their first appearance, so that the 
+    # cluster ids don't depend on how the graphs were grouped.
+    cluster_ids = [None] * len(hashes)
+    ordered_groups = sorted(groups.values(), key=lambda x: x[0])
+
+    for cluster_id, group in enumerate(ordered_groups, 1):
+        for i in group:
+            cluster_ids[i] = cluster_id
+
+    return cluster_ids
+
+def _split_isomorphic_graphs(graphs):
+    confirmed_groups = []
+
+    for k, graph in enumerate(graphs):
+        g = _nx_from_labeled_graph(*graph)
+
+        for subgroup, g0 in confirmed_groups:
+            if nx.is_isomorphic(g, g0, op.eq, op.eq):
+                subgroup.append(k)
+                break
+        else:
+            confirmed_groups.append(([k], g))
+
+    return [subgroup for subgroup, _ in confirmed_groups]
+
+def _make_pool(jobs):
+    if jobs == 1:
+        return nullcontext()
+
+    from multiprocessing import get_context
+    return get_context('spawn').Pool(jobs)
+
+def _imap(pool, f, iterable, chunksize=1):
+    if pool is None:
+        return map(f, iterable)
+    else:
+        return pool.imap(f, iterable, chunksize=chunksize)
+
+def _canonicalize_forest(labels, edges):
+    adjacency = [[] for _ in labels]
+
+    for i, j, label in edges:
+        adjacency[i].append((j, label))
+        adjacency[j].append((i, label))
+
+    forms = []
+    visited = set()
+
+    for root in range(len(labels)):
+        if root in visited:
+            continue
+
+        component = _find_connected_component(adjacency, root)
+        visited.update(component)
+
+        # A connected graph is a tree if and only if it has one fewer edge 
+        # than it has nodes.  Self-loops count as one edge here, but appear 
+        # twice in the adjacency list.
+        num_edges = sum(len(adjacency[i]) for i in component) / 2
+        if num_edges != len(component) - 1:
+            return None
+
+        forms.append(_canonicalize_tree(labels, adjacency, component))
+
+    return ''.join(sorted(forms))
+
+def _canonicalize_tree(labels, adjacency, nodes):
+    # Every tree has either one or two "centers", i.e. nodes that are as far 
+    # as possible from the leaves.  Find them by repeatedly removing leaves.  
+    # The canonical form of the tree is then the smallest canonical form of 
+    # the tree rooted at one of these centers.
+
+    degrees = {i: len(adjacency[i]) for i in nodes}
+    leaves = [i for i in nodes if degrees[i] <= 1]
+    num_remaining = len(nodes)
+
+    while num_remaining > 2:
+        num_remaining -= len(leaves)
+        next_leaves = []
+
+        for i in leaves:
+            for j, _ in adjacency[i]:
+                degrees[j] -= 1
+                if degrees[j] == 1:
+                    next_leaves.append(j)
+
+        leaves = next_leaves
+
+    return min(
+            _canonicalize_rooted_tree(labels, adjacency, center)
+            for center in leaves
+    )
+
+def _canonicalize_rooted_tree(labels, adjacency, root):
+    # This is the AHU algorithm: the canonical form of each node is its label 
+    # followed by the sorted canonical forms of its children (each prefixed by 
+    # the label of the edge leading to that child).  The labels are reprs, so 
+    # they can't be confused with the brackets used to delimit them.
+
+    parents = {root: None}
+    order = [root]
+
+    for i in order:
+        for j, _ in adjacency[i]:
+            if j not in parents:
+                parents[j] = i
+                order.append(j)
+
+    forms = {}
+
+    for i in reversed(order):
+        children = sorted(
+                f'[{edge_label}]{forms[j]}'
+                for j, edge_label in adjacency[i]
+                if j != parents[i]
+        )
+        forms[i] = f'({labels[i]}{"".join(children)})'
+
+    return forms[root]
+
+def _find_connected_component(adjacency, root):
+    component = [root]
+    visited = {root}
+
+    for i in component:
+        for j, _ in adjacency[i]:
+            if j not in visited:
+                visited.add(j)
+                component.append(j)
+
+    return component
@@ -1,6 +1,6 @@
 """\
 Usage:
-    mmc_ingest_chemicals <in:db> <in:chem_comp>
+    mmc_ingest_chemicals <in:db> <in:chem_comp> [--used-only]
 
 Arguments:
     <in:db>
@@ -9,14 +9,22 @@ Arguments:
 
     <in:chem_comp>
         The path to a mmCIF file containing all the chemical components present 
-        in the PDB.
+        in the PDB, optionally compressed with gzip.  The file is read one 
+        block at a time, so it never has to fit in memory all at once.
+
+Options:
+    --used-only
+        Only ingest the chemical components that appear as monomer entities 
+        in the database.  The blocks for all other components are skipped 
+        without being parsed, which is much faster for databases that only 
+        contain a subset of the PDB.
 """
 
 import polars as pl
+import pyarrow as pa
 
-from .util import extract_dataframe
+from .util import iter_cif_blocks, extract_dataframe
 from .database_io import open_db, insert_chemical_components
-from gemmi.cif import read as read_cif
 from tqdm import tqdm
 
 def main():
@@ -24,22 +32,58 @@ def main():
 
     args = docopt.docopt(__doc__)
     db = open_db(args['<in:db>'])
-    cif = read_cif(args['<in:chem_comp>'])
+    block_names = select_used_component_ids(db) if args['--used-only'] else None
+    blocks = iter_cif_blocks(args['<in:chem_comp>'], block_names=block_names)
 
-    def cif_wrapper(cif):
-        for block in (progress_bar := tqdm(cif)):
+    def cif_wrapper(blocks):
+        for block in (progress_bar := tqdm(blocks)):
             progress_bar.set_description(block.name)
             yield block
 
-    ingest_chemical_components(db, cif_wrapper(cif))
+    ingest_chemical_components(db, cif_wrapper(blocks))
 
-def ingest_chemical_components(db, cif):
-    df = pl.DataFrame(
-            extract_chemical_component(block)
-            for block in cif
-    )
+def ingest_chemical_components(db, cif, chunk_size=10_000):
+    # Convert the components into Arrow arrays one chunk at a time.  Arrow 
+    # stores the strings contiguously, so this keeps the memory overhead per 
+    # component much smaller than keeping a Python string (let alone a 
+    # dictionary) for each one.
+    schema = pa.schema([
+        ('id', pa.string()),
+        ('inchi', pa.string()),
+        ('inchi_key', pa.string()),
+    ])
+    batches = []
+    cols = {k: [] for k in schema.names}
+
+    def flush_chunk():
+        batch = pa.record_batch(
+                [pa.array(cols[k], type=pa.string()) for k in schema.names],
+                schema=schema,
+        )
+        batches.append(batch)
+
+        for v in cols.values():
+            v.clear()
+
+    for block in cif:
+        for k, v in extract_chemical_component(block).items():
+            cols[k].append(v)
+
+        if len(cols['id']) >= chunk_size:
+            flush_chunk()
+
+    flush_chunk()
+
+    df = pl.from_arrow(pa.Table.from_batches(batches, schema=schema))
     insert_chemical_components(db, df)
 
+def select_used_component_ids(db):
+    return set(
+            db.sql('SELECT DISTINCT pdb_comp_id FROM entity_monomer')
+            .pl()
+            .get_column('pdb_comp_id')
+    )
+
 def extract_chemical_component(block):
     chem_comp_descriptor = (
             extract_dataframe(
@@ -1,91 +1,441 @@
 """\
 Usage:
-    ingest_structures <in:db-path> <in:cif-dir> [--skip-huge]
+    ingest_structures <in:db-path> <in:cif-dir> [--skip-huge] [--update]
+        [-m <path>] [-j <int>] [-b <int>]
 
 Arguments:
     <in:cif-dir>
         The path to a directory containing the structures to ingest, in mmCIF 
         format.  The directory must be organized in the same way as the PDB, 
-        e.g.: <in:cif-dir>/xy/9xyz.cif.gz
+        e.g.: <in:cif-dir>/xy/9xyz.cif.gz.  Only the two levels of this 
+        layout are searched, so other files and directories can be kept 
+        alongside the structures without slowing anything down.
 
 Options:
     --skip-huge
         Skip structures with `*.cif.gz` files that are bigger than 50 MB.  
-        These structures require much more memory to process, so it can be 
-        convenient to process them all at once after the bulk of the PDB has 
-        been ingested (possibly on a more powerful computer).
+        This option used to be necessary because these structures required 
+        much more memory to process, but now only the few `_atom_site` columns 
+        that are actually needed are loaded into memory.  The option remains 
+        in case it's still convenient to process the biggest structures 
+        separately.
+
+    --update
+        Bring the database up to date with the given directory, e.g. after 
+        syncing a local mirror of the PDB.  Structures with files that have 
+        changed size or modification time since they were ingested will be 
+        deleted and re-ingested, and structures that no longer have files 
+        (i.e. obsoleted entries) will be deleted.  Without this option, only 
+        structures that aren't already in the database are ingested.
+
+        Note that deleting a structure also deletes any data derived from it, 
+        e.g. validation metrics, ranks, and clusters.  Blacklisted structures 
+        will remain blacklisted after being re-ingested.  If `--skip-huge` is 
+        also given, structures with huge files are left as they are.
+
+    -m --manifest <path>
+        Read the structures to ingest from the given file, rather than 
+        searching the <in:cif-dir> directory for them.  This is much faster 
+        for big mirrors on network filesystems.  The manifest can either be a 
+        text file or a JSON file (optionally compressed with gzip):
+
+        - Each line of a text file should be either a PDB id or the path to 
+          an mmCIF file, relative to <in:cif-dir>.  Blank lines and lines 
+          beginning with '#' are ignored.
+
+        - A JSON file should contain an object with PDB ids as keys, e.g. 
+          the `current_file_holdings.json.gz` file distributed by the PDB.  
+          The values are ignored.
+
+        PDB ids are converted to paths of the form <in:cif-dir>/xy/9xyz.cif.gz.
+
+    -j --jobs <int>  [default: 1]
+        The number of processes to use for parsing mmCIF files.  Parsing is 
+        the slowest part of ingesting a structure, so it's done by a pool of 
+        worker processes.  A single process (this one) is responsible for 
+        writing to the database.
+
+    -b --batch-size <int>  [default: 100]
+        The number of structures to insert into the database at once.  Each 
+        batch is inserted using one statement per table, and committed as a 
+        single transaction.
 """
 
 import polars as pl
 
 from .database_io import (
         open_db, transaction,
-        insert_structure, select_structures, create_structure_indices,
+        insert_structures, insert_structure_files,
+        insert_pending_blacklisted_structures, restore_blacklisted_structures,
+        delete_structures, create_structure_indices,
 )
-from .util import read_cif, extract_dataframe
-from .error import IngestError, add_path_to_ingest_error
-from more_itertools import one
+from .util import read_cif, extract_dataframe, tquiet
+from .error import (
+        IngestError, IngestFailure, add_path_to_ingest_error,
+        insert_batch_and_blame_path,
+)
+from more_itertools import one, chunked
+from pathlib import Path
 from datetime import date
 
+import os
+
 def main():
     import docopt
-    from pathlib import Path
+    from functools import partial
     from tqdm import tqdm
 
     args = docopt.docopt(__doc__)
     cif_dir = Path(args['<in:cif-dir>'])
     db = open_db(args['<in:db-path>'])
 
-    cif_paths = find_uningested_paths(
-            db,
-            cif_paths=tqdm(
-                cif_dir.glob('**/*.cif*'),
-                desc='find paths to ingest',
-            ),
+    if args['--manifest']:
+        cif_paths = read_manifest(args['--manifest'], cif_dir)
+    else:
+        cif_paths = find_cif_paths(cif_dir)
+
+    cif_paths = tqdm(cif_paths, desc='find paths to ingest')
+    kwargs = dict(
             pdb_id_from_path=lambda p: p.name.split('.')[0],
             skip_huge=args['--skip-huge'],
+            stats={},
+            jobs=int(args['--jobs']),
+            batch_size=int(args['--batch-size']),
+            progress_factory=partial(tqdm, desc='ingest structures'),
     )
-    ingest_structures(db, tqdm(cif_paths, desc='ingest structures'))
 
-def find_uningested_paths(db, cif_paths, *, pdb_id_from_path, skip_huge=False):
+    if args['--update']:
+        update_structures(db, cif_paths, **kwargs)
+    else:
+        ingest_new_structures(db, cif_paths, **kwargs)
+
+def ingest_new_structures(
+        db,
+        cif_paths,
+        *,
+        pdb_id_from_path,
+        skip_huge=False,
+        stats=None,
+        **kwargs,
+):
+    cif_paths = find_uningested_paths(
+            db, cif_paths,
+            pdb_id_from_path=pdb_id_from_path,
+            skip_huge=skip_huge,
+            stats=stats,
+    )
+    ingest_structures(db, cif_paths, stats=stats, **kwargs)
+
+def update_structures(
+        db,
+        cif_paths,
+        *,
+        pdb_id_from_path,
+        skip_huge=False,
+        stats=None,
+        **kwargs,
+):
+    cif_paths, stale_struct_ids = find_updated_paths(
+            db, cif_paths,
+            pdb_id_from_path=pdb_id_from_path,
+            skip_huge=skip_huge,
+            stats=stats,
+    )
 
-    def safe_pdb_id_from_path(path):
-        pdb_id = pdb_id_from_path(path)
-        assert len(pdb_id) == 4
-        return pdb_id
+    # Deleting a structure also deletes its blacklist entry, so record which 
+    # structures were blacklisted before deleting anything, and restore those 
+    # entries afterwards.  The record is kept in the database, so if some of 
+    # the structures fail to be re-ingested, their entries will be restored by 
+    # whichever later update does manage to re-ingest them.
+    insert_pending_blacklisted_structures(db, stale_struct_ids)
+    delete_structures(db, stale_struct_ids)
+
+    try:
+        ingest_structures(db, cif_paths, stats=stats, **kwargs)
+    finally:
+        restore_blacklisted_structures(db)
+
+def find_cif_paths(cif_dir):
+    """
+    Find all of the mmCIF files in the given directory.
+
+    The directory must be organized in the same way as the PDB, i.e. with 
+    each structure in a subdirectory named after the middle two characters of 
+    its PDB id.  Only these two levels are searched, and `os.scandir()` is 
+    used to do so, because it can tell files from directories without making 
+    a separate system call for each one.  This matters a lot for network 
+    filesystems, where every system call is slow.
+
+    The paths are yielded in sorted order, so that structures are always 
+    ingested in the same order.
+    """
+    for hash_dir in _scandir_sorted(cif_dir):
+        if not hash_dir.is_dir():
+            continue
 
-    already_ingested = set(select_structures(db)['pdb_id'].unique())
+        for entry in _scandir_sorted(hash_dir.path):
+            if entry.is_file() and '.cif' in entry.name:
+                yield Path(entry.path)
+
+def read_manifest(manifest_path, cif_dir):
+    """
+    Read the paths to the mmCIF files listed in the given manifest.
+
+    See the description of the `--manifest` option for the supported file 
+    formats.  Note that the paths are not checked for existence.
+    """
+    manifest_path = Path(manifest_path)
+    cif_dir = Path(cif_dir)
+
+    if manifest_path.name.endswith('.gz'):
+        import gzip
+        open_manifest = gzip.open
+    else:
+        open_manifest = open
+
+    with open_manifest(manifest_path, 'rt') as f:
+        if '.json' in manifest_path.suffixes:
+            import json
+            entries = list(json.load(f))
+        else:
+            entries = [
+                    line for line in map(str.strip, f)
+                    if line and not line.startswith('#')
+            ]
+
+    def path_from_entry(entry):
+        if len(entry) == 4 and entry.isalnum():
+            pdb_id = entry.lower()
+            return cif_dir / pdb_id[1:3] / f'{pdb_id}.cif.gz'
+        else:
+            return cif_dir / entry
+
+    return [path_from_entry(x) for x in entries]
+
+def find_uningested_paths(
+        db,
+        cif_paths,
+        *,
+        pdb_id_from_path,
+        skip_huge=False,
+        stats=None,
+):
+    already_ingested = set(
+            db.sql('SELECT DISTINCT pdb_id FROM structure').pl()['pdb_id']
+    )
     return [
             p for p in cif_paths
-            if (safe_pdb_id_from_path(p) not in already_ingested)
-            and ((not skip_huge) or p.stat().st_size < 50_000_000)
+            if (
+                _safe_pdb_id_from_path(pdb_id_from_path, p)
+                not in already_ingested
+            )
+            and (
+                (not skip_huge) or
+                _stat(p, stats).st_size < 50_000_000
+            )
     ]
 
-def ingest_structures(db, cif_paths):
-    # Multiprocessing makes this go faster, but causes weird incompatibilities 
-    # with tidyexc.  This is ultimately a bug in tidyexc, and I want to fix it 
-    # eventually, but for now I'm just going to return to the non-parallel 
-    # algorithm.
-
-    # from multiprocessing import get_context
-    # 
-    # with get_context("spawn").Pool() as pool:
-    #     for kwargs in pool.imap_unordered(
-    #             _get_insert_structure_kwargs,
-    #             cif_paths,
-    #             chunksize=10,
-    #     ):
-    #         with transaction(db):
-    #             insert_structure(db, **kwargs)
-
-    for cif_path in cif_paths:
-        with add_path_to_ingest_error(cif_path):
-             kwargs = _get_insert_structure_kwargs(cif_path)
-             with transaction(db):
-                 insert_structure(db, **kwargs)
+def find_updated_paths(
+        db,
+        cif_paths,
+        *,
+        pdb_id_from_path,
+        skip_huge=False,
+        stats=None,
+):
+    """
+    Compare the given files to the structures already in the database.
+
+    Returns:
+        A tuple with two items:
+
+        - A list of paths that need to be ingested, either because they're 
+          new or because they've changed since they were last ingested.
+        - A list of primary keys for structures that need to be deleted, 
+          either because they've changed (and will be re-ingested) or because 
+          they no longer have files (i.e. they've been obsoleted).
+
+    A file is considered to have changed if its size or modification time 
+    differs from when it was ingested.  Structures that were ingested before 
+    this information was recorded are always considered to have changed.
+
+    If a *stats* dictionary is given, it will be used to cache the result of 
+    calling `stat()` on each path.  Pass the same dictionary to 
+    `ingest_structures()` to avoid calling `stat()` on each file twice.
+    """
+    cif_paths = list(cif_paths)
+    files = pl.DataFrame(
+            [
+                dict(
+                    path_i=i,
+                    pdb_id=_safe_pdb_id_from_path(pdb_id_from_path, p),
+                    size_bytes=(st := _stat(p, stats)).st_size,
+                    mtime_ns=st.st_mtime_ns,
+                )
+                for i, p in enumerate(cif_paths)
+            ],
+            schema={
+                'path_i': int,
+                'pdb_id': str,
+                'size_bytes': int,
+                'mtime_ns': int,
+            },
+    )
+    ingested = db.sql('''\
+            SELECT
+                structure.id AS struct_id,
+                structure.pdb_id AS pdb_id,
+                structure_file.size_bytes AS ingested_size_bytes,
+                structure_file.mtime_ns AS ingested_mtime_ns
+            FROM structure
+            LEFT JOIN structure_file ON structure.id = structure_file.struct_id
+    ''').pl()
+
+    # Huge files are skipped entirely (if requested).  That means not 
+    # ingesting them, but also not deleting the structures that were 
+    # previously ingested from them, even if the files have changed.
+    df = (
+            files
+            .join(ingested, on='pdb_id', how='full', coalesce=True)
+            .with_columns(
+                is_new=pl.col('struct_id').is_null(),
+                is_obsolete=pl.col('path_i').is_null(),
+                is_changed=(
+                    pl.col('size_bytes').ne_missing(pl.col('ingested_size_bytes')) |
+                    pl.col('mtime_ns').ne_missing(pl.col('ingested_mtime_ns'))
+                ),
+                is_skipped=(
+                    pl.lit(skip_huge) &
+                    (pl.col('size_bytes') >= 50_000_000).fill_null(False)
+                ),
+            )
+    )
+
+    stale_struct_ids = (
+            df
+            .filter(
+                ~pl.col('is_new') & (
+                    pl.col('is_obsolete') | pl.col('is_changed')
+                ),
+                ~pl.col('is_skipped'),
+            )
+            .get_column('struct_id')
+            .sort()
+            .to_list()
+    )
+    ingest_paths = (
+            df
+            .filter(
+                ~pl.col('is_obsolete') & (
+                    pl.col('is_new') | pl.col('is_changed')
+                ),
+                ~pl.col('is_skipped'),
+            )
+            .get_column('path_i')
+            .sort()
+    )
+    return [cif_paths[i] for i in ingest_paths], stale_struct_ids
+
+def _safe_pdb_id_from_path(pdb_id_from_path, path):
+    pdb_id = pdb_id_from_path(path)
+    assert len(pdb_id) == 4
+    return pdb_id
+
+def _scandir_sorted(dir):
+    with os.scandir(dir) as entries:
+        return sorted(entries, key=lambda x: x.name)
+
+def _stat(path, stats):
+    if stats is None:
+        return path.stat()
+
+    try:
+        return stats[path]
+    except KeyError:
+        stats[path] = st = path.stat()
+        return st
+
+def ingest_structures(
+        db,
+        cif_paths,
+        *,
+        jobs=1,
+        batch_size=1,
+        progress_factory=tquiet,
+        stats=None,
+):
+    cif_paths = list(cif_paths)
+    progress = progress_factory(
+            _parse_structures(cif_paths, jobs),
+            total=len(cif_paths),
+    )
+
+    for batch in chunked(progress, batch_size):
+        _insert_batch(db, batch, stats)
 
     create_structure_indices(db)
 
+def _insert_batch(db, batch, stats):
+    insert_batch_and_blame_path(
+            lambda batch: _insert_structures(db, batch, stats),
+            batch,
+    )
+
+def _insert_structures(db, batch, stats):
+    cif_paths = [cif_path for cif_path, _ in batch]
+    structures = [kwargs for _, kwargs in batch]
+
+    with transaction(db):
+        struct_ids = insert_structures(db, structures)
+
+        # Record the size and modification time of each file, so that it's 
+        # possible to tell if the file changes after being ingested.
+        file_stats = [_stat(cif_path, stats) for cif_path in cif_paths]
+        files = pl.DataFrame({
+            'struct_id': struct_ids,
+            'size_bytes': [st.st_size for st in file_stats],
+            'mtime_ns': [st.st_mtime_ns for st in file_stats],
+        })
+        insert_structure_files(db, files)
+
+def _parse_structures(cif_paths, jobs):
+    if jobs == 1:
+        for cif_path in cif_paths:
+            with add_path_to_ingest_error(cif_path):
+                kwargs = _get_insert_structure_kwargs(cif_path)
+            yield cif_path, kwargs
+        return
+
+    # The workers only parse the mmCIF files.  All of the data they send back 
+    # (data frames, dates, strings) can be pickled, so a single process can 
+    # own the database connection.  Exceptions are another story: tidyexc 
+    # exceptions can't be pickled, so errors are sent back as plain records and 
+    # turned back into exceptions here.
+    #
+    # Use `imap()` rather than `imap_unordered()`, so that structures are 
+    # inserted in the same order (and therefore get the same primary keys) 
+    # regardless of how many processes are used.
+
+    from multiprocessing import get_context
+
+    with get_context('spawn').Pool(jobs) as pool:
+        for cif_path, kwargs, failure in pool.imap(
+                _parse_structure,
+                cif_paths,
+        ):
+            if failure is not None:
+                raise failure.to_error()
+
+            yield cif_path, kwargs
+
+def _parse_structure(cif_path):
+    try:
+        with add_path_to_ingest_error(cif_path):
+            return cif_path, _get_insert_structure_kwargs(cif_path), None
+
+    except IngestError as err:
+        return cif_path, None, IngestFailure.from_error(err)
+
 def _get_insert_structure_kwargs(cif_path):
     cif = read_cif(cif_path)
     pdb_id = cif.name.lower()
@@ -140,6 +490,9 @@ def _extract_models_subchains_assemblies(cif):
                 'details',
                 'oligomeric_count',
             ],
+            schema={
+                'oligomeric_count': int,
+            },
     )
     struct_assembly_gen = extract_dataframe(
             cif, 'pdbx_struct_assembly_gen',
@@ -154,7 +507,7 @@ def _extract_models_subchains_assemblies(cif):
             .select(
                 pl.col('id'),
                 pl.col('details').alias('type'),
-                pl.col('oligomeric_count').cast(int).alias('polymer_count'),
+                pl.col('oligomeric_count').alias('polymer_count'),
             )
     )
 
@@ -335,6 +688,11 @@ def _extract_xtal_quality(cif):
                     'ls_R_factor_R_free',
                     'ls_R_factor_R_work',
                 ],
+                schema={
+                    'ls_d_res_high': float,
+                    'ls_R_factor_R_free': float,
+                    'ls_R_factor_R_work': float,
+                },
             )
             .rename({
                 'ls_d_res_high': 'resolution_A',
@@ -342,7 +700,7 @@ def _extract_xtal_quality(cif):
                 'ls_R_factor_R_work': 'r_work',
             })
             .select(
-                pl.col('*').cast(float).replace(0, None),
+                pl.all().replace(0, None),
             )
     )
 
@@ -362,9 +720,10 @@ def _extract_em_quality(cif):
             extract_dataframe(
                 cif, 'em_3d_reconstruction',
                 optional_cols=['resolution'],
+                schema={'resolution': float},
             )
             .select(
-                resolution_A=pl.col('resolution').cast(float)
+                resolution_A='resolution',
             )
     )
 
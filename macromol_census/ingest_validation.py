@@ -2,7 +2,7 @@
 Ingest data from validation reports provided by the PDB.
 
 Usage:
-    mmc_ingest_validation <in:db> <in:validation-dir>
+    mmc_ingest_validation <in:db> <in:validation-dir> [-c <int>] [-j <int>]
 
 Arguments:
     <in:db>
@@ -12,67 +12,199 @@ Arguments:
     <in:validation-dir>
         The path to a directory containing PDB validation reports, in the 
         `*.cif.gz` format.
+
+Options:
+    -c --checkpoint-size <int>  [default: 1000]
+        The number of validation reports to ingest between commits.  If the 
+        program is interrupted, only the reports since the last commit will be 
+        lost.  Reports that have already been ingested are skipped, so the 
+        program can simply be restarted to pick up where it left off.
+
+    -j --jobs <int>  [default: 1]
+        The number of processes to use for parsing validation reports.  The 
+        workers only send back the handful of values that are extracted from 
+        each report, and a single process (this one) is responsible for 
+        writing to the database.
 """
 
 import polars as pl
 import re
 
 from .database_io import (
-        open_db, transaction, select_structure_id,
-        insert_nmr_quality, insert_em_quality, insert_clashscore,
+        open_db, transaction,
+        insert_nmr_qualities, insert_em_qualities, insert_clashscores,
+        insert_quality_sources,
 )
-from .util import read_cif, extract_dataframe
-from .error import add_path_to_ingest_error
-from more_itertools import only
+from .util import read_cif, extract_dataframe, tquiet
+from .error import (
+        IngestError, IngestFailure, add_path_to_ingest_error,
+        insert_batch_and_blame_path,
+)
+from more_itertools import only, chunked
 from pathlib import Path
 from tqdm import tqdm
 
 def main():
     import docopt
+    from functools import partial
 
     args = docopt.docopt(__doc__)
     db = open_db(args['<in:db>'])
     val_dir = Path(args['<in:validation-dir>'])
-    cif_paths = val_dir.glob('**/*_validation.cif.gz')
+    cif_paths = find_uningested_validation_reports(
+            db, val_dir.glob('**/*_validation.cif.gz'),
+            pdb_id_from_path=lambda p: p.name.split('_')[0],
+    )
+
+    ingest_validation_reports(
+            db, cif_paths,
+            checkpoint_size=int(args['--checkpoint-size']),
+            jobs=int(args['--jobs']),
+            progress_factory=partial(tqdm, desc='ingest validation reports'),
+    )
+
+def find_uningested_validation_reports(db, cif_paths, *, pdb_id_from_path):
+    already_ingested = set(
+            db.sql('''\
+                SELECT structure.pdb_id
+                FROM quality_source
+                JOIN structure ON structure.id = quality_source.struct_id
+                WHERE quality_source.source = 'mmcif_pdbx_vrpt'
+            ''').pl()['pdb_id']
+    )
+    return [
+            p for p in cif_paths
+            if pdb_id_from_path(p) not in already_ingested
+    ]
 
-    ingest_validation_reports(db, tqdm(list(cif_paths)))
+def ingest_validation_reports(
+        db,
+        cif_paths,
+        *,
+        checkpoint_size=1000,
+        jobs=1,
+        progress_factory=tquiet,
+):
+    # Commit periodically, so that an interruption doesn't throw away all the 
+    # work that's been done so far.  Each report is recorded in the 
+    # `quality_source` table in the same transaction as its data, so the 
+    # database always knows exactly which reports have been ingested.
 
-def ingest_validation_reports(db, cif_paths):
-    # If the program gets interrupted by some sort of error, there's no easy 
-    # way to tell where we left off and to restart from there.  So instead, 
-    # wrap the whole program in a single transaction.
+    cif_paths = list(cif_paths)
+    progress = progress_factory(
+            _parse_reports(cif_paths, jobs),
+            total=len(cif_paths),
+    )
+
+    for batch in chunked(progress, checkpoint_size):
+        _insert_batch(db, batch)
+
+def ingest_validation_report(db, cif_path):
+    _insert_batch(db, list(_parse_reports([cif_path], jobs=1)))
+
+def _insert_batch(db, batch):
+    insert_batch_and_blame_path(
+            lambda batch: _insert_reports(db, batch),
+            batch,
+    )
+
+def _insert_reports(db, batch):
+    reports = pl.DataFrame(
+            [report for _, report in batch if report is not None],
+            schema={
+                'pdb_id': str,
+                'num_dist_restraints': int,
+                'resolution_A': float,
+                'q_score': float,
+                'clashscore': float,
+            },
+    )
+
+    # Look up the primary keys for every report in the batch at once.  
+    # Reports for structures that aren't in the database are skipped.
+    struct_ids = db.execute('''\
+            SELECT id AS struct_id, pdb_id
+            FROM structure
+            SEMI JOIN reports USING (pdb_id)
+    ''').pl()
+    reports = (
+            reports
+            .join(struct_ids, on='pdb_id')
+            .with_columns(source=pl.lit('mmcif_pdbx_vrpt'))
+    )
 
     with transaction(db):
+        insert_nmr_qualities(
+                db, reports.filter(pl.col('num_dist_restraints') > 0),
+        )
+        insert_em_qualities(
+                db, reports.filter(
+                    pl.col('resolution_A').is_not_null() |
+                    pl.col('q_score').is_not_null()
+                ),
+        )
+        insert_clashscores(
+                db, reports.filter(pl.col('clashscore').is_not_null()),
+        )
+        insert_quality_sources(db, reports)
+
+def _parse_reports(cif_paths, jobs):
+    if jobs == 1:
         for cif_path in cif_paths:
-            ingest_validation_report(db, cif_path)
+            with add_path_to_ingest_error(cif_path):
+                report = _extract_report(cif_path)
+            yield cif_path, report
+        return
 
-def ingest_validation_report(db, cif_path):
-    with add_path_to_ingest_error(cif_path):
-        cif = read_cif(cif_path)
-        pdb_id = cif.name.lower()
+    # See `ingest_structures._parse_structures()`.  Validation reports are 
+    # small and quick to parse, so send them to the workers in chunks to cut 
+    # down on communication overhead.
 
-        # At the time I wrote this code, there were 30 validation reports that 
-        # didn't specify a PDB ID, instead just giving the string "BlockName".  
-        # In these cases, try to parse the ID from the file name, and give up 
-        # if that doesn't work.
+    from multiprocessing import get_context
 
-        if pdb_id == 'blockname':
-            if m := re.match(r'(\w{4})_validation.cif.gz', cif_path.name):
-                pdb_id = m.group(1)
-            else:
-                return
+    with get_context('spawn').Pool(jobs) as pool:
+        for cif_path, report, failure in pool.imap(
+                _parse_report,
+                cif_paths,
+                chunksize=16,
+        ):
+            if failure is not None:
+                raise failure.to_error()
 
-        struct_id = select_structure_id(db, pdb_id)
-        source=dict(source='mmcif_pdbx_vrpt')
+            yield cif_path, report
 
-        if n := _extract_nmr_restraints(cif):
-            insert_nmr_quality(db, struct_id, **source, num_dist_restraints=n)
+def _parse_report(cif_path):
+    try:
+        with add_path_to_ingest_error(cif_path):
+            return cif_path, _extract_report(cif_path), None
 
-        if kw := _extract_em_resolution_q_score(cif):
-            insert_em_quality(db, struct_id, **source, **kw)
+    except IngestError as err:
+        return cif_path, None, IngestFailure.from_error(err)
 
-        if x := _extract_clashscore(cif):
-            insert_clashscore(db, struct_id, **source, clashscore=x)
+def _extract_report(cif_path):
+    cif = read_cif(cif_path)
+    pdb_id = cif.name.lower()
+
+    # At the time I wrote this code, there were 30 validation reports that 
+    # didn't specify a PDB ID, instead just giving the string "BlockName".  In 
+    # these cases, try to parse the ID from the file name, and give up if that 
+    # doesn't work.
+
+    if pdb_id == 'blockname':
+        if m := re.match(r'(\w{4})_validation.cif.gz', cif_path.name):
+            pdb_id = m.group(1)
+        else:
+            return None
+
+    em = _extract_em_resolution_q_score(cif) or {}
+
+    return dict(
+            pdb_id=pdb_id,
+            num_dist_restraints=_extract_nmr_restraints(cif),
+            resolution_A=em.get('resolution_A'),
+            q_score=em.get('q_score'),
+            clashscore=_extract_clashscore(cif),
+    )
 
 def _extract_nmr_restraints(cif):
     restraint_summary = extract_dataframe(
@@ -101,14 +233,16 @@ def _extract_em_resolution_q_score(cif):
                     'EMDB_resolution',
                     'Q_score',
                 ],
+                schema={
+                    'EMDB_resolution': float,
+                    'Q_score': float,
+                },
+                strict=False,
             )
             .select(
                 resolution_A='EMDB_resolution',
                 q_score='Q_score',
             )
-            .select(
-                pl.col('*').cast(float, strict=False)
-            )
             .to_dicts()
     )
 
@@ -117,9 +251,10 @@ def _extract_clashscore(cif):
             extract_dataframe(
                 cif, 'pdbx_vrpt_summary_geometry',
                 optional_cols=['clashscore'],
+                schema={'clashscore': float},
+                strict=False,
             )
             .get_column('clashscore')
-            .cast(float, strict=False)
             .replace(-1, None)
     )
 
@@ -2,23 +2,37 @@
 Pick a non-redundant set of biological assemblies.
 
 Usage:
-    mmc_pick_assemblies <in:db>
+    mmc_pick_assemblies <in:db> [--saved-ranked-subchains]
 
 Arguments:
     <in:db>
         A database created by the various `mmc_ingest_*` commands.
+
+Options:
+    --saved-ranked-subchains
+        Get the ranked list of subchains to consider from the 
+        `ranked_subchain` table, rather than recalculating it.  If this table 
+        doesn't exist yet, or if any of the tables it's derived from have 
+        changed since it was saved (e.g. after an update or a re-rank), it 
+        will be recalculated.  Calculating this table requires joining most of 
+        the database, so saving it can speed up repeated runs.
 """
 
 import polars as pl
+import numpy as np
 import pickle
+import os
 import operator as op
 
 from .database_io import open_db, transaction
 from .util import tquiet
 from dataclasses import dataclass
-from itertools import combinations, combinations_with_replacement
+from bisect import bisect_left
+from itertools import combinations
 from more_itertools import one, flatten
 from functools import reduce, cached_property
+from contextlib import contextmanager
+from pathlib import Path
 from tqdm import tqdm
 
 from typing import TypeAlias, TypeVar, Callable
@@ -43,28 +57,28 @@ class Visitor:
 
 class Structure:
 
-    def __init__(self, db, struct_id):
+    def __init__(self, db, struct_id, pdb_id, model_pdb_ids):
+        # See `Assembly.__init__()`.  The PDB ids for every structure that 
+        # will be visited are loaded in bulk before any visiting begins, 
+        # because querying them one structure at a time is slow.
         self._db = db
         self._struct_id = struct_id
+        self._pdb_id = pdb_id
+        self._model_pdb_ids = model_pdb_ids
 
     def __repr__(self):
         return f'<Structure {self.pdb_id}>'
 
+    def __getstate__(self):
+        return _drop_db(self.__dict__)
+
     @property
     def pdb_id(self):
-        df = self._db.sql(
-                'SELECT pdb_id FROM structure WHERE id = ?',
-                params=[self._struct_id],
-        ).pl()
-        return df['pdb_id'].item()
+        return self._pdb_id
 
-    @cached_property
+    @property
     def model_pdb_ids(self):
-        df = self._db.sql(
-                'SELECT pdb_id FROM model WHERE struct_id = ?',
-                params=[self._struct_id],
-        ).pl()
-        return df['pdb_id'].to_list()
+        return self._model_pdb_ids
 
 class Assembly:
 
@@ -81,33 +95,279 @@ class Assembly:
     def __repr__(self):
         return f'<Assembly {self.pdb_id}>'
 
+    def __getstate__(self):
+        return _drop_db(self.__dict__)
+
     @cached_property
     def pdb_id(self):
-        df = self._db.sql(
-                'SELECT pdb_id FROM assembly WHERE id = ?',
-                params=[self._assembly_id],
-        ).pl()
-        return df['pdb_id'].item()
+        return self._subchain_clusters['assembly_pdb_id'][0]
 
     @cached_property
     def subchain_pdb_ids(self):
         return self._subchain_clusters['subchain_pdb_id'].to_list()
 
+def _drop_db(state):
+    # Database connections can't be pickled, so structures and assemblies sent 
+    # to worker processes (see `visit_assemblies()`) can't query the database.
+    return {**state, '_db': None}
+
 class Memento:
 
     def __init__(self):
         self._assembly_id = None
-        self._accepted_clusters = set()
-        self._accepted_cluster_pairs = set()
+        self._accepted_clusters = _ClusterSet()
+        self._accepted_cluster_pairs = _ClusterPairSet()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # Older mementos stored the accepted clusters in plain sets.
+        if isinstance(self._accepted_clusters, set):
+            self._accepted_clusters = _ClusterSet(self._accepted_clusters)
+        if isinstance(self._accepted_cluster_pairs, set):
+            self._accepted_cluster_pairs = \
+                    _ClusterPairSet(self._accepted_cluster_pairs)
 
     def save(self, path):
-        with open(path, 'wb') as f:
+        with _atomic_open(path) as f:
             pickle.dump(self, f)
 
+    def save_parquet(self, path):
+        """
+        Save the accepted clusters and cluster pairs in the Parquet format.
+
+        This is much faster to save and load than a pickle, because the 
+        clusters are stored as arrays rather than Python objects.  However, 
+        any other attributes that a visitor may have added to the memento are 
+        not saved.  Use `load()` to read the file back in.
+        """
+        df = pl.DataFrame([
+            pl.Series(
+                'assembly_id',
+                [self._assembly_id],
+                dtype=pl.Int64,
+            ),
+            pl.Series(
+                'accepted_clusters',
+                [np.fromiter(self._accepted_clusters, dtype=np.uint32)],
+                dtype=pl.List(pl.UInt32),
+            ),
+            pl.Series(
+                'accepted_cluster_pairs',
+                [self._accepted_cluster_pairs._keys()],
+                dtype=pl.List(pl.UInt64),
+            ),
+        ])
+        with _atomic_open(path) as f:
+            df.write_parquet(f)
+
     @classmethod
     def load(cls, path):
         with open(path, 'rb') as f:
-            return pickle.load(f)
+            is_parquet = (f.read(4) == b'PAR1')
+            f.seek(0)
+
+            if not is_parquet:
+                return pickle.load(f)
+
+        df = pl.read_parquet(path)
+        clusters = df['accepted_clusters'][0].to_numpy()
+        cluster_pairs = df['accepted_cluster_pairs'][0].to_numpy()
+
+        self = cls()
+        self._assembly_id = df['assembly_id'][0]
+        self._accepted_clusters = _ClusterSet.from_array(
+                clusters.astype(np.int64),
+        )
+        self._accepted_cluster_pairs = _ClusterPairSet.from_keys(
+                cluster_pairs.astype(np.uint64),
+        )
+        return self
+
+class _ClusterSet:
+    """
+    A set of cluster ids, stored as a bitmap.
+
+    Cluster ids are small, dense, non-negative integers (see 
+    `_select_relevant_subchains()`), so each can simply be used as an index 
+    into the bitmap.  This takes much less memory than a set of Python 
+    integers, and makes it possible to check many clusters at once.
+    """
+
+    def __init__(self, clusters=()):
+        self._bits = np.zeros(0, dtype=np.uint8)
+        for cluster in clusters:
+            self.add(cluster)
+
+    def __contains__(self, cluster):
+        # This gets called once per candidate subchain, so avoid creating any 
+        # arrays.
+        byte, bit = divmod(int(cluster), 8)
+        if not 0 <= byte < len(self._bits):
+            return False
+        return bool((int(self._bits[byte]) >> bit) & 1)
+
+    def __iter__(self):
+        bits = np.unpackbits(self._bits, bitorder='little')
+        yield from map(int, np.flatnonzero(bits))
+
+    def __len__(self):
+        return int(np.unpackbits(self._bits).sum())
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    @classmethod
+    def from_array(cls, clusters):
+        self = cls()
+        if len(clusters):
+            assert clusters.min() >= 0
+            self._bits = np.zeros(clusters.max() // 8 + 1, dtype=np.uint8)
+            np.bitwise_or.at(
+                    self._bits,
+                    clusters // 8,
+                    (1 << (clusters % 8)).astype(np.uint8),
+            )
+        return self
+
+    def add(self, cluster):
+        assert cluster >= 0
+        byte, bit = divmod(int(cluster), 8)
+
+        if byte >= len(self._bits):
+            # Grow geometrically, so that adding clusters in increasing order 
+            # doesn't require copying the bitmap every time.
+            n = max(byte + 1, 2 * len(self._bits))
+            self._bits = np.pad(self._bits, (0, n - len(self._bits)))
+
+        self._bits[byte] |= 1 << bit
+
+    def contains_all(self, clusters):
+        clusters = np.asarray(clusters, dtype=np.int64)
+        bytes, bits = np.divmod(clusters, 8)
+
+        in_range = (clusters >= 0) & (bytes < len(self._bits))
+        if not in_range.all():
+            return False
+
+        return bool(((self._bits[bytes] >> bits) & 1).all())
+
+class _ClusterPairSet:
+    """
+    A set of cluster pairs, with each pair packed into a single 64-bit integer.
+
+    Most of the pairs are stored in a sorted array, which is compact and can 
+    be searched for many pairs at once.  Newly added pairs are buffered in a 
+    regular set, and merged into the array once enough of them accumulate.
+    """
+
+    def __init__(self, pairs=()):
+        self._sorted_keys = np.zeros(0, dtype=np.uint64)
+        self._pending_keys = set()
+        for pair in pairs:
+            self.add(pair)
+
+    def __contains__(self, pair):
+        return self._contains_key(_pack_cluster_pair(pair))
+
+    def __iter__(self):
+        self._merge_pending_keys()
+        for key in self._sorted_keys:
+            yield int(key >> 32), int(key & 0xffffffff)
+
+    def __len__(self):
+        return len(self._sorted_keys) + len(self._pending_keys)
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __getstate__(self):
+        self._merge_pending_keys()
+        return self.__dict__
+
+    @classmethod
+    def from_keys(cls, keys):
+        self = cls()
+        self._sorted_keys = np.unique(keys)
+        return self
+
+    def add(self, pair):
+        key = _pack_cluster_pair(pair)
+        if self._contains_key(key):
+            return
+
+        self._pending_keys.add(key)
+
+        if len(self._pending_keys) > max(1024, len(self._sorted_keys) // 8):
+            self._merge_pending_keys()
+
+    def contains_all(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        missing = keys[~_isin_sorted(keys, self._sorted_keys)]
+        return all(int(k) in self._pending_keys for k in missing)
+
+    def _contains_key(self, key):
+        # This gets called once per candidate subchain pair, so avoid creating 
+        # any arrays.
+        if key in self._pending_keys:
+            return True
+
+        i = bisect_left(self._sorted_keys, key)
+        return i < len(self._sorted_keys) and int(self._sorted_keys[i]) == key
+
+    def _keys(self):
+        self._merge_pending_keys()
+        return self._sorted_keys
+
+    def _merge_pending_keys(self):
+        if not self._pending_keys:
+            return
+
+        pending = np.fromiter(self._pending_keys, dtype=np.uint64)
+        self._sorted_keys = np.union1d(self._sorted_keys, pending)
+        self._pending_keys = set()
+
+@contextmanager
+def _atomic_open(path):
+    # Write to a temporary file in the same directory, then move it into 
+    # place.  This way, an interruption can't leave behind a partially 
+    # written file.
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+
+    try:
+        with open(tmp_path, 'wb') as f:
+            yield f
+        os.replace(tmp_path, path)
+
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def _pack_cluster_pair(pair):
+    # Same as `_pack_cluster_pairs()`, but for a single pair.  This is called 
+    # much too often to afford the overhead of creating arrays.
+    lo, hi = sorted(map(int, pair))
+    assert lo >= 0 and hi < 2**32
+    return (lo << 32) | hi
+
+def _pack_cluster_pairs(clusters_1, clusters_2):
+    clusters_1 = np.asarray(clusters_1, dtype=np.int64)
+    clusters_2 = np.asarray(clusters_2, dtype=np.int64)
+
+    assert (clusters_1 >= 0).all() and (clusters_1 < 2**32).all()
+    assert (clusters_2 >= 0).all() and (clusters_2 < 2**32).all()
+
+    lo = np.minimum(clusters_1, clusters_2).astype(np.uint64)
+    hi = np.maximum(clusters_1, clusters_2).astype(np.uint64)
+    return (lo << np.uint64(32)) | hi
+
+def _isin_sorted(needles, haystack):
+    if len(haystack) == 0:
+        return np.zeros(len(needles), dtype=bool)
+
+    i = np.searchsorted(haystack, needles)
+    i = np.minimum(i, len(haystack) - 1)
+    return haystack[i] == needles
 
 @dataclass
 class Candidate:
@@ -122,9 +382,13 @@ def main():
     db = open_db(args['<in:db>'])
 
     with transaction(db):
-        pick_assemblies(db, progress_factory=tqdm)
+        pick_assemblies(
+                db,
+                progress_factory=tqdm,
+                saved_ranked_subchains=args['--saved-ranked-subchains'],
+        )
 
-def pick_assemblies(db, progress_factory=tquiet):
+def pick_assemblies(db, progress_factory=tquiet, saved_ranked_subchains=False):
     nonredundant = []
     nonredundant_pairs = []
 
@@ -206,7 +470,15 @@ def pick_assemblies(db, progress_factory=tquiet):
     class PickCandidate(Candidate):
         subchain_ids: list[int]
 
-    visit_assemblies(db, PickVisitor, progress_factory=progress_factory)
+    # This visitor proposes every subchain and subchain pair, so every 
+    # cluster and cluster pair that it's offered will be accepted.  That makes 
+    # it possible to work out which assemblies are redundant in advance.
+    visit_assemblies(
+            db, PickVisitor,
+            progress_factory=progress_factory,
+            saved_ranked_subchains=saved_ranked_subchains,
+            skip_redundant_assemblies=True,
+    )
 
     nonredundant_df = pl.DataFrame(
             nonredundant,
@@ -226,7 +498,19 @@ def pick_assemblies(db, progress_factory=tquiet):
             SELECT subchain_id_1, subchain_id_2 FROM nonredundant_pairs_df;
     ''')
 
-def visit_assemblies(db, visitor_factory, *, memento=None, progress_factory=tquiet):
+def visit_assemblies(
+        db,
+        visitor_factory,
+        *,
+        memento=None,
+        progress_factory=tquiet,
+        saved_ranked_subchains=False,
+        skip_redundant_assemblies=False,
+        jobs=1,
+        checkpoint_path=None,
+        checkpoint_every=1000,
+        checkpoint_seconds=600,
+):
     """
     KBK: Below is an outline of the original algorithm I planned.  The final 
     version ended up a little different, but I haven't updated the notes yet.  
@@ -275,32 +559,27 @@ def visit_assemblies(db, visitor_factory, *, memento=None, progress_factory=tqui
     if memento is None:
         memento = Memento()
 
-    relevant_subchains = _select_relevant_subchains(db)
-    relevant_assemblies = _select_relevant_assemblies(db, relevant_subchains)
-    ranked_subchains = db.sql('''\
-            SELECT
-                structure.id AS struct_id,
-                structure.pdb_id AS struct_pdb_id,
-                structure.rank AS struct_rank,
-                assembly.id AS assembly_id,
-                relevant_assemblies.rank AS assembly_rank,
-                subchain.chain_id AS chain_id,
-                subchain.id AS subchain_id,
-                subchain.pdb_id AS subchain_pdb_id,
-                relevant_subchains.cluster_id AS cluster_id
-            FROM relevant_assemblies
-            JOIN assembly ON assembly.id = relevant_assemblies.assembly_id
-            JOIN assembly_subchain USING (assembly_id)
-            JOIN structure ON structure.id = assembly.struct_id
-            JOIN subchain ON subchain.id = assembly_subchain.subchain_id
-            JOIN relevant_subchains USING (subchain_id)
-            ORDER BY struct_rank, assembly_rank, chain_id, subchain_id
-    ''').pl()
-
-    # This isn't guaranteed to free the memory used by these data frames, but 
-    # it at least makes it possible for that to happen.
-    del relevant_subchains
-    del relevant_assemblies
+    if saved_ranked_subchains:
+        if not _is_saved_ranked_subchains_current(db):
+            save_ranked_subchains(db)
+        ranked_subchains = db.sql(f'''\
+                SELECT * FROM ranked_subchain
+                ORDER BY {_RANKED_SUBCHAIN_ORDER}
+        ''').pl()
+    else:
+        ranked_subchains = _select_ranked_subchains(db)
+
+    # This has to happen before the assemblies that were already visited are 
+    # removed, because it depends on every assembly that came before.
+    if skip_redundant_assemblies:
+        ranked_subchains = (
+                ranked_subchains
+                .join(
+                    _find_redundant_assemblies(ranked_subchains),
+                    on='assembly_id',
+                    how='anti',
+                )
+        )
 
     if (last_assembly_id := memento._assembly_id) is not None:
         last_struct_rank, last_assembly_rank = \
@@ -316,77 +595,407 @@ def visit_assemblies(db, visitor_factory, *, memento=None, progress_factory=tqui
                 )
         )
 
+    model_pdb_ids = _select_model_pdb_ids(
+            db, ranked_subchains['struct_id'].unique(),
+    )
+
     n = ranked_subchains.n_unique('struct_id')
     progress = progress_factory(total=n)
 
     def all_clusters_redundant(subchain_clusters):
-        clusters = set(subchain_clusters['cluster_id'])
-        if clusters - memento._accepted_clusters:
+        clusters = np.unique(subchain_clusters['cluster_id'].to_numpy())
+        if not memento._accepted_clusters.contains_all(clusters):
             return False
 
-        cluster_pairs = set(
-                combinations_with_replacement(sorted(clusters), r=2)
-        )
-        if cluster_pairs - memento._accepted_cluster_pairs:
+        # Every pair of clusters, including each cluster with itself.
+        i, j = np.triu_indices(len(clusters))
+        cluster_pairs = _pack_cluster_pairs(clusters[i], clusters[j])
+        if not memento._accepted_cluster_pairs.contains_all(cluster_pairs):
             return False
 
         return True
 
+    def accept_candidates(visitor, assembly_id, assembly_subchains, candidates):
+        subchain_col = getattr(visitor, '_subchain_col', 'subchain_pdb_id')
+        cluster_map = dict(
+                assembly_subchains
+                .select(subchain_col, 'cluster_id')
+                .iter_rows()
+        )
+        accepted_candidate_indices = set()
+
+        _accept_nonredundant_subchains(
+                candidates,
+                cluster_map,
+                accepted_candidate_indices,
+                memento._accepted_clusters,
+        )
+        _accept_nonredundant_subchain_pairs(
+                candidates,
+                cluster_map,
+                accepted_candidate_indices,
+                memento._accepted_cluster_pairs,
+        )
+
+        accepted_candidates = [
+                candidates[i]
+                for i in sorted(accepted_candidate_indices)
+        ]
+
+        memento._assembly_id = assembly_id
+        visitor.accept(accepted_candidates, memento)
+
+    def checkpoint_periodically(structures):
+        return _checkpoint_periodically(
+                structures,
+                memento,
+                checkpoint_path,
+                checkpoint_every,
+                checkpoint_seconds,
+        )
+
+    structures = _iter_structures(db, ranked_subchains, model_pdb_ids)
+
+    if jobs == 1:
+        for struct, struct_subchains_i, assemblies in (
+                checkpoint_periodically(structures)
+        ):
+            progress.set_description(struct.pdb_id)
+            progress.update()
+
+            if all_clusters_redundant(struct_subchains_i):
+                continue
+
+            visitor = visitor_factory(struct)
+
+            for assembly in assemblies:
+                assembly_subchains_j = assembly._subchain_clusters
+                if all_clusters_redundant(assembly_subchains_j):
+                    continue
+
+                candidates = list(visitor.propose(assembly))
+                accept_candidates(
+                        visitor,
+                        assembly._assembly_id,
+                        assembly_subchains_j,
+                        candidates,
+                )
+
+    else:
+        # Propose candidates for upcoming structures in worker processes, but 
+        # accept them here, strictly in order.  This gives the same results 
+        # as the serial algorithm, provided that `propose()` doesn't depend on 
+        # anything that happens in `accept()`.  Note that candidates are 
+        # proposed even for assemblies that turn out to be redundant, and 
+        # that `accept()` is called on a copy of the visitor that was sent 
+        # back from the worker.
+
+        for (struct, struct_subchains_i, assemblies), visitor, candidates_j in (
+                checkpoint_periodically(
+                    _propose_in_parallel(visitor_factory, structures, jobs)
+                )
+        ):
+            progress.set_description(struct.pdb_id)
+            progress.update()
+
+            if all_clusters_redundant(struct_subchains_i):
+                continue
+
+            for assembly, candidates in zip(assemblies, candidates_j):
+                assembly_subchains_j = assembly._subchain_clusters
+                if all_clusters_redundant(assembly_subchains_j):
+                    continue
+
+                accept_candidates(
+                        visitor,
+                        assembly._assembly_id,
+                        assembly_subchains_j,
+                        candidates,
+                )
+
+def _iter_structures(db, ranked_subchains, model_pdb_ids):
     for (struct_id, struct_pdb_id), struct_subchains_i in (
             ranked_subchains.group_by(
                 ['struct_id', 'struct_pdb_id'],
                 maintain_order=True,
             )
     ):
-        progress.set_description(struct_pdb_id)
-        progress.update()
+        struct = Structure(
+                db, struct_id, struct_pdb_id,
+                model_pdb_ids.get(struct_id, []),
+        )
+        assemblies = [
+                Assembly(db, assembly_id, assembly_subchains_j)
+                for (assembly_id,), assembly_subchains_j in (
+                    struct_subchains_i.group_by(
+                        ['assembly_id'],
+                        maintain_order=True,
+                    )
+                )
+        ]
+        yield struct, struct_subchains_i, assemblies
+
+def _checkpoint_periodically(
+        structures,
+        memento,
+        checkpoint_path,
+        checkpoint_every,
+        checkpoint_seconds,
+):
+    # The code after each `yield` runs once the caller has finished with the 
+    # previous structure, so the memento never reflects a partially visited 
+    # structure.  If the caller raises an exception, this generator is never 
+    # resumed and no checkpoint is made.
+
+    if checkpoint_path is None:
+        yield from structures
+        return
+
+    from time import monotonic
+
+    n = 0
+    t0 = monotonic()
+
+    for structure in structures:
+        yield structure
+        n += 1
+
+        if n >= checkpoint_every or monotonic() - t0 >= checkpoint_seconds:
+            memento.save_parquet(checkpoint_path)
+            n = 0
+            t0 = monotonic()
+
+    if n:
+        memento.save_parquet(checkpoint_path)
+
+def _propose_in_parallel(visitor_factory, structures, jobs):
+    from multiprocessing import get_context
+    from collections import deque
+
+    # Don't let the workers get too far ahead, because every pending structure 
+    # takes up memory in this process.
+    max_pending = 4 * jobs
+    pending = deque()
+
+    def get_result():
+        item, result = pending.popleft()
+        visitor, candidates = result.get()
+        return item, visitor, candidates
+
+    with get_context('spawn').Pool(jobs) as pool:
+        for item in structures:
+            struct, _, assemblies = item
+            result = pool.apply_async(
+                    _propose_candidates,
+                    (visitor_factory, struct, assemblies),
+            )
+            pending.append((item, result))
 
-        if all_clusters_redundant(struct_subchains_i):
-            continue
+            if len(pending) >= max_pending:
+                yield get_result()
 
-        struct = Structure(db, struct_id)
-        visitor = visitor_factory(struct)
-        subchain_col = getattr(visitor, '_subchain_col', 'subchain_pdb_id')
+        while pending:
+            yield get_result()
 
-        for (assembly_id,), assembly_subchains_j in (
-                struct_subchains_i.group_by(
-                    ['assembly_id'],
-                    maintain_order=True,
-                )
-        ):
-            if all_clusters_redundant(assembly_subchains_j):
-                continue
+def _propose_candidates(visitor_factory, struct, assemblies):
+    visitor = visitor_factory(struct)
+    candidates = [
+            list(visitor.propose(assembly))
+            for assembly in assemblies
+    ]
+    return visitor, candidates
 
-            assembly = Assembly(db, assembly_id, assembly_subchains_j)
-            candidates = list(visitor.propose(assembly))
+def save_ranked_subchains(db):
+    """
+    Save the ranked list of subchains considered by `visit_assemblies()` to 
+    the `ranked_subchain` table, replacing that table if it already exists.
+
+    All of the numeric columns in this table are 32-bit integers, so it can be 
+    loaded directly by subsequent calls to `visit_assemblies()`.  A 
+    fingerprint of the tables that the ranking depends on is saved alongside 
+    it, so that `visit_assemblies()` can tell when the saved table is out of 
+    date.
+    """
+    ranked_subchains = _select_ranked_subchains(db)
+    fingerprint = _select_ranked_subchains_fingerprint(db)
 
-            cluster_map = dict(
-                    assembly_subchains_j
-                    .select(subchain_col, 'cluster_id')
-                    .iter_rows()
-            )
-            accepted_candidate_indices = set()
+    db.execute('''\
+            CREATE OR REPLACE TABLE ranked_subchain AS
+            SELECT * FROM ranked_subchains
+    ''')
+    db.execute('''\
+            CREATE OR REPLACE TABLE ranked_subchain_fingerprint AS
+            SELECT ?::STRING AS fingerprint
+    ''', [fingerprint])
+
+def _is_saved_ranked_subchains_current(db):
+    if not _has_table(db, 'ranked_subchain'):
+        return False
+    if not _has_table(db, 'ranked_subchain_fingerprint'):
+        return False
+
+    # A table saved by an older version of this module might not have the 
+    # columns that this version expects.
+    schema = db.execute('''\
+            SELECT column_name, column_type
+            FROM (DESCRIBE ranked_subchain)
+    ''').fetchall()
+
+    if dict(schema) != _RANKED_SUBCHAIN_SCHEMA:
+        return False
+
+    saved = db.execute('''\
+            SELECT fingerprint FROM ranked_subchain_fingerprint
+    ''').fetchall()
+
+    return saved == [(_select_ranked_subchains_fingerprint(db),)]
+
+def _select_ranked_subchains_fingerprint(db):
+    # Summarize each table that the ranked subchains are derived from by its 
+    # row count and the sum of its row hashes.  This requires scanning each 
+    # table once, but no joins, so it's much cheaper than recalculating the 
+    # ranked subchains.  Any inserted, deleted, or modified row (e.g. by 
+    # re-ingesting a structure, or re-ranking) changes the fingerprint.
+    tables = [
+            'structure',
+            'structure_blacklist',
+            'assembly',
+            'assembly_subchain',
+            'assembly_rank',
+            'subchain',
+            'entity',
+            'entity_cluster',
+            'entity_ignore',
+            'quality_xtal',
+            'quality_em',
+    ]
+    summaries = ' UNION ALL '.join(
+            f"SELECT '{table}' AS name, count(*) AS n, "
+            f"coalesce(sum(hash({table})), 0) AS h FROM {table}"
+            for table in tables
+    )
+    return db.execute(f'''\
+            SELECT string_agg(concat_ws(':', name, n, h), ';' ORDER BY name)
+            FROM ({summaries})
+    ''').fetchone()[0]
+
+# The columns of the `ranked_subchain` table, and the order in which the 
+# subchains are visited.  If the query in `_select_ranked_subchains()` 
+# changes, these must change with it.
+_RANKED_SUBCHAIN_SCHEMA = {
+        'struct_id': 'INTEGER',
+        'struct_pdb_id': 'VARCHAR',
+        'struct_rank': 'INTEGER',
+        'assembly_id': 'INTEGER',
+        'assembly_pdb_id': 'VARCHAR',
+        'assembly_rank': 'INTEGER',
+        'chain_id': 'INTEGER',
+        'subchain_id': 'INTEGER',
+        'subchain_pdb_id': 'VARCHAR',
+        'cluster_id': 'INTEGER',
+}
+_RANKED_SUBCHAIN_ORDER = 'struct_rank, assembly_rank, chain_id, subchain_id'
+
+def _select_ranked_subchains(db):
+    relevant_subchains = _select_relevant_subchains(db)
+    relevant_assemblies = _select_relevant_assemblies(db, relevant_subchains)
+
+    return db.sql(f'''\
+            SELECT
+                structure.id::INT AS struct_id,
+                structure.pdb_id AS struct_pdb_id,
+                structure.rank::INT AS struct_rank,
+                assembly.id::INT AS assembly_id,
+                assembly.pdb_id AS assembly_pdb_id,
+                relevant_assemblies.rank::INT AS assembly_rank,
+                subchain.chain_id::INT AS chain_id,
+                subchain.id::INT AS subchain_id,
+                subchain.pdb_id AS subchain_pdb_id,
+                relevant_subchains.cluster_id::INT AS cluster_id
+            FROM relevant_assemblies
+            JOIN assembly ON assembly.id = relevant_assemblies.assembly_id
+            JOIN assembly_subchain USING (assembly_id)
+            JOIN structure ON structure.id = assembly.struct_id
+            JOIN subchain ON subchain.id = assembly_subchain.subchain_id
+            JOIN relevant_subchains USING (subchain_id)
+            ORDER BY {_RANKED_SUBCHAIN_ORDER}
+    ''').pl()
+
+def _find_redundant_assemblies(ranked_subchains):
+    """
+    Find assemblies that are certain to be skipped by `visit_assemblies()`.
 
-            _accept_nonredundant_subchains(
-                    candidates,
-                    cluster_map,
-                    accepted_candidate_indices,
-                    memento._accepted_clusters,
+    Returns:
+        A dataframe with one column, ``assembly_id``.
+
+    This is only correct for visitors that accept every cluster and cluster 
+    pair that they haven't seen before, i.e. visitors that propose every 
+    subchain and subchain pair.  For these visitors, the clusters and cluster 
+    pairs that have been accepted by the time any particular assembly is 
+    reached are exactly those that appeared in earlier assemblies.  So an 
+    assembly is redundant if (i) all of its clusters appeared in earlier 
+    assemblies and (ii) every pair of its clusters (including each cluster 
+    paired with itself) appeared as a pair of subchains in an earlier 
+    assembly.  This can be worked out for every assembly at once, which is 
+    much faster than checking them one at a time.
+    """
+    assembly_clusters = (
+            ranked_subchains
+            .with_row_index('row_i')
+            .with_columns(
+                # Number the assemblies in the order they'll be visited.
+                assembly_i=pl.col('row_i').min().over('assembly_id'),
+            )
+            .group_by('assembly_i', 'assembly_id', 'cluster_id')
+            .agg(
+                n=pl.len(),
+            )
+            .with_columns(
+                first_assembly_i=pl.col('assembly_i').min().over('cluster_id'),
+            )
+    )
+    assembly_cluster_pairs = (
+            assembly_clusters
+            .select('assembly_i', 'cluster_id', 'n')
+            .join(assembly_clusters, on='assembly_i', suffix='_2')
+            .filter(
+                pl.col('cluster_id') <= pl.col('cluster_id_2'),
+            )
+            .with_columns(
+                # A cluster only forms a subchain pair with itself if the 
+                # assembly has more than one subchain in that cluster.
+                is_subchain_pair=(
+                    (pl.col('cluster_id') != pl.col('cluster_id_2')) |
+                    (pl.col('n') > 1)
+                ),
             )
-            _accept_nonredundant_subchain_pairs(
-                    candidates,
-                    cluster_map,
-                    accepted_candidate_indices,
-                    memento._accepted_cluster_pairs,
+            .with_columns(
+                first_assembly_i=(
+                    pl.col('assembly_i')
+                    .filter('is_subchain_pair')
+                    .min()
+                    .over('cluster_id', 'cluster_id_2')
+                ),
             )
+    )
 
-            accepted_candidates = [
-                    candidates[i]
-                    for i in sorted(accepted_candidate_indices)
-            ]
+    def find_covered_assemblies(df):
+        is_covered = pl.col('first_assembly_i') < pl.col('assembly_i')
+        return (
+                df
+                .group_by('assembly_id')
+                .agg(is_covered=is_covered.fill_null(False).all())
+                .filter('is_covered')
+                .select('assembly_id')
+        )
 
-            memento._assembly_id = assembly_id
-            visitor.accept(accepted_candidates, memento)
+    return (
+            find_covered_assemblies(assembly_clusters)
+            .join(
+                find_covered_assemblies(assembly_cluster_pairs),
+                on='assembly_id',
+            )
+    )
 
 def _select_relevant_subchains(db):
     """
@@ -516,6 +1125,23 @@ def _select_relevant_assemblies(db, subchain_cluster):
             ANTI JOIN assembly_low_res USING (assembly_id)
     ''').pl()
 
+def _has_table(db, name):
+    df = db.sql(
+            'SELECT table_name FROM duckdb_tables() WHERE table_name = ?',
+            params=[name],
+    ).pl()
+    return not df.is_empty()
+
+def _select_model_pdb_ids(db, struct_ids):
+    struct_ids = pl.DataFrame({'struct_id': struct_ids})
+    df = db.sql('''\
+            SELECT struct_id, list(pdb_id ORDER BY id) AS model_pdb_ids
+            FROM model
+            SEMI JOIN struct_ids USING (struct_id)
+            GROUP BY struct_id
+    ''').pl()
+    return dict(df.iter_rows())
+
 def _select_assembly_rank(db, assembly_id):
     df = db.sql('''\
             SELECT
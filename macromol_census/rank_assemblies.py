@@ -3,12 +3,18 @@ Determine the order in which the assemblies within each structure will be
 considered.
 
 Usage:
-    mmc_find_assembly_subchain_cover <in:db>
+    mmc_find_assembly_subchain_cover <in:db> [-j <int>]
 
 Arguments:
     <in:db>
         The path to a database created by the `mmc_ingest_mmcif` command.
 
+Options:
+    -j --jobs <int>  [default: 1]
+        The number of processes to use when finding the smallest set of 
+        assemblies needed to include every subchain in each structure.  The 
+        results don't depend on the number of processes.
+
 Note that the rankings produced by this script only apply to the assemblies 
 within a single structure.  Assemblies from different structures are not 
 ranked; see the `mmc_rank_structures` for that.  That said, ranking the 
@@ -24,6 +30,7 @@ import numpy as np
 import polars as pl
 
 from scipy.optimize import milp, Bounds, LinearConstraint
+from scipy.sparse import csc_array
 from .database_io import open_db, insert_assembly_ranks
 from .util import tquiet
 from tqdm import tqdm
@@ -34,10 +41,10 @@ def main():
 
     db = open_db(args['<in:db>'])
 
-    ranks = rank_assemblies(db, tqdm)
+    ranks = rank_assemblies(db, tqdm, jobs=int(args['--jobs']))
     insert_assembly_ranks(db, ranks)
 
-def rank_assemblies(db, progress_factory=tquiet):
+def rank_assemblies(db, progress_factory=tquiet, jobs=1):
     assemblies = db.sql('''\
             SELECT
                 assembly.struct_id AS struct_id,
@@ -56,20 +63,7 @@ def rank_assemblies(db, progress_factory=tquiet):
             ON assembly.id = assembly_subchain.assembly_id
     ''').pl()
 
-    n = assemblies.n_unique('struct_id')
-    progress = progress_factory(total=n)
-
-    def filter_subchain_cover(df):
-        progress.update(1)
-        cover = find_assembly_subchain_cover(
-                df
-                .explode('subchain_ids')
-                .rename({'subchain_ids': 'subchain_id'})
-        )
-        return df.filter(pl.col('assembly_id').is_in(cover))
-
-
-    return (
+    candidates = (
             assemblies
 
             # Only keep assemblies that are "biologically relevant" (see #1):
@@ -88,11 +82,16 @@ def rank_assemblies(db, progress_factory=tquiet):
             # subchains:
             .group_by('struct_id', 'subchain_ids')
             .agg(pl.all().sort_by('polymer_count').last())
+    )
 
-            # Only keep the minimum number of assemblies needed to include 
-            # every subchain:
-            .group_by('struct_id')
-            .map_groups(filter_subchain_cover)
+    # Only keep the minimum number of assemblies needed to include every 
+    # subchain:
+    progress = progress_factory(total=candidates.n_unique('struct_id'))
+    cover = _find_covers(candidates, jobs, progress)
+
+    return (
+            candidates
+            .filter(pl.col('assembly_id').is_in(cover))
 
             # Rank remaining assemblies by size, then by order of appearance in 
             # the mmCIF file:
@@ -107,7 +106,65 @@ def rank_assemblies(db, progress_factory=tquiet):
             )
     )
                 
-def find_assembly_subchain_cover(assembly_subchain):
+def _find_covers(assemblies, jobs, progress, chunk_size=1000):
+    # Each structure is independent, so divide the structures into chunks and 
+    # find the covers for each chunk separately (and possibly in parallel).  
+    # Chunks are much cheaper to send to worker processes than individual 
+    # structures.
+
+    chunks = (
+            assemblies
+            .select('struct_id', 'assembly_id', 'subchain_ids')
+            .with_columns(
+                chunk=(pl.col('struct_id').rank('dense') - 1) // chunk_size,
+            )
+            .partition_by('chunk', include_key=False, maintain_order=True)
+    )
+    covers = []
+
+    def process_results(results):
+        for cover, num_structs in results:
+            covers.extend(cover)
+            progress.update(num_structs)
+
+    if jobs == 1:
+        cache = {}
+        process_results(
+                _find_covers_in_chunk(chunk, cache)
+                for chunk in chunks
+        )
+
+    else:
+        from multiprocessing import get_context
+
+        with get_context('spawn').Pool(jobs) as pool:
+            process_results(pool.imap(_find_covers_in_chunk, chunks))
+
+    return covers
+
+def _find_covers_in_chunk(assemblies, cache=None):
+    # Most structures have one of a handful of very common assembly/subchain 
+    # patterns, so remember the covers that have already been found.  Worker 
+    # processes get a new cache for each chunk, so the cache never has to be 
+    # sent between processes.
+    if cache is None:
+        cache = {}
+
+    cover = []
+
+    for _, assemblies_i in assemblies.group_by('struct_id'):
+        cover_i = find_assembly_subchain_cover(
+                assemblies_i
+                .select('assembly_id', 'subchain_ids')
+                .explode('subchain_ids')
+                .rename({'subchain_ids': 'subchain_id'}),
+                cache=cache,
+        )
+        cover.extend(cover_i['assembly_id'])
+
+    return cover, assemblies.n_unique('struct_id')
+
+def find_assembly_subchain_cover(assembly_subchain, cache=None):
     assembly_i = (
             assembly_subchain
             .select('assembly_id')
@@ -141,32 +198,179 @@ def find_assembly_subchain_cover(assembly_subchain):
     # - Each column corresponds to an assembly
     # - Each row corresponds to a subchain
     # - Each value is 1 if the assembly contains the subchain, 0 otherwise.
+    #
+    # Some structures (e.g. viral capsids) have lots of subchains, so use a 
+    # sparse matrix.
 
-    A = np.zeros((len(subchain_i), len(assembly_i)))
-    A[i['subchain_i'], i['assembly_i']] = 1
-
-    res = milp(
-            c=np.ones(len(assembly_i)),
-            integrality=np.ones(len(assembly_i)),
-            bounds=Bounds(lb=0, ub=1),
-            constraints=LinearConstraint(A, lb=1),
+    A = csc_array(
+            (
+                np.ones(len(i), dtype=np.int64),
+                (i['subchain_i'].to_numpy(), i['assembly_i'].to_numpy()),
+            ),
+            shape=(len(subchain_i), len(assembly_i)),
     )
-    assert res.success
+    A.sum_duplicates()
+    A.data[:] = 1
+
+    if cache is None:
+        cover = _find_cover(A)
+    else:
+        cover = _find_cover_cached(A, cache)
 
     covering_assembly = (
             assembly_i
-            .join(
-                pl.DataFrame({
-                    'assembly_i': np.arange(len(assembly_i)),
-                    'select': res.x.astype(int),
-                }),
-                on='assembly_i',
-            )
             .filter(
-                pl.col('select') != 0
+                pl.col('assembly_i').is_in(cover)
             )
             .select('assembly_id')
     )
     return covering_assembly
 
+def _find_cover(A):
+    """
+    Find the smallest set of columns in the given matrix that together have a 
+    nonzero value in every row.
+
+    Arguments:
+        A:
+            A sparse matrix of 0s and 1s.  Every row must have at least one 
+            nonzero value.
+
+    Returns:
+        The indices of the chosen columns, in sorted order.
+
+    This is the set cover problem, which is NP-hard in general.  But the 
+    instances that come up in practice are almost always easy, so first try 
+    to simplify the problem as much as possible:
+
+    - Remove any columns that are subsets of other columns.  There's always an 
+      optimal cover that doesn't include such columns.
+
+    - Add any columns that are the only way to cover some row.  These columns 
+      must be part of every cover.
+
+    Repeat until neither step makes any more progress.  The MILP solver is 
+    only needed for whatever's left after that, which is usually nothing.
+    """
+    rows = np.arange(A.shape[0])
+    cols = np.arange(A.shape[1])
+    cover = []
+
+    while len(rows):
+        B = A[rows][:, cols]
+        cols, B = _remove_dominated_cols(cols, B)
+
+        row_counts = B.sum(axis=1)
+        essential_rows = np.flatnonzero(row_counts == 1)
+
+        if not len(essential_rows):
+            break
+
+        essential_cols = np.unique(B[essential_rows].nonzero()[1])
+        cover.extend(cols[essential_cols])
+
+        covered_rows = B[:, essential_cols].sum(axis=1) > 0
+        rows = rows[~covered_rows]
+        cols = np.delete(cols, essential_cols)
+
+    if len(rows):
+        B = A[rows][:, cols]
+        res = milp(
+                c=np.ones(len(cols)),
+                integrality=np.ones(len(cols)),
+                bounds=Bounds(lb=0, ub=1),
+                constraints=LinearConstraint(B, lb=1),
+        )
+        assert res.success
+        cover.extend(cols[np.round(res.x) != 0])
+
+    return np.sort(np.array(cover, dtype=int))
+
+def _find_cover_cached(A, cache):
+    """
+    Find the same kind of cover as `_find_cover()`, but reuse the answer from 
+    any previous matrix with the same pattern of nonzero values, up to the 
+    order of the rows and columns.
+
+    Arguments:
+        A:
+            A sparse matrix of 0s and 1s.  Every row must have at least one 
+            nonzero value.
+
+        cache:
+            A dictionary mapping canonical matrices to covers.  This will be 
+            updated with the cover for *A*, if it isn't already present.
+    """
+    key, B, cols = _canonicalize_incidence(A)
+
+    try:
+        cover = cache[key]
+    except KeyError:
+        cover = cache[key] = _find_cover(B)
+
+    # The cached cover was found for the canonical matrix, so it's the same 
+    # regardless of which matrix happened to populate the cache.
+    return np.sort(cols[cover])
+
+def _canonicalize_incidence(A):
+    # Relabel the rows and columns according to properties that don't depend 
+    # on their original order: columns by size and by the degrees of the rows 
+    # they cover, then rows by degree and by the (relabeled) columns that 
+    # cover them.  Ties are broken by the original order.  This isn't a true 
+    # canonical form, so it's possible for two matrices that are permutations 
+    # of each other to end up with different keys.  But that only costs a 
+    # cache miss; matrices with the same key are always identical.
+
+    A = csc_array(A)
+    A.sort_indices()
+
+    row_degrees = A.sum(axis=1)
+    col_sizes = A.sum(axis=0)
+
+    def col_signature(j):
+        rows = A.indices[A.indptr[j]:A.indptr[j+1]]
+        return -col_sizes[j], tuple(np.sort(row_degrees[rows]))
+
+    cols = np.array(
+            sorted(range(A.shape[1]), key=col_signature),
+            dtype=int,
+    )
+    A = A[:, cols].tocsr()
+    A.sort_indices()
+
+    def row_signature(i):
+        return row_degrees[i], tuple(A.indices[A.indptr[i]:A.indptr[i+1]])
+
+    rows = np.array(
+            sorted(range(A.shape[0]), key=row_signature),
+            dtype=int,
+    )
+    B = csc_array(A[rows])
+    B.sort_indices()
+
+    key = (
+            B.shape,
+            B.indptr.astype(np.int64).tobytes(),
+            B.indices.astype(np.int64).tobytes(),
+    )
+    return key, B, cols
+
+def _remove_dominated_cols(cols, B):
+    # Column *i* is dominated by column *j* if every row covered by *i* is 
+    # also covered by *j*.  Among columns that cover exactly the same rows, 
+    # keep the first.  Columns that don't cover any rows are dominated by 
+    # every other column, and are also removed.
+
+    sizes = B.sum(axis=0)
+    overlap = (B.T @ B).toarray()
+    i = np.arange(len(cols))
+
+    is_subset = (overlap == sizes[:, None])
+    is_bigger = (sizes[None, :] > sizes[:, None])
+    is_earlier = (sizes[None, :] == sizes[:, None]) & (i[None, :] < i[:, None])
+
+    dominated = (is_subset & (is_bigger | is_earlier)).any(axis=1)
+    dominated |= (sizes == 0)
 
+    keep = np.flatnonzero(~dominated)
+    return cols[keep], B[:, keep]
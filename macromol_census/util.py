@@ -9,43 +9,149 @@ def read_cif(path):
     from gemmi.cif import read
     return read(str(path)).sole_block()
 
+def iter_cif_blocks(path, *, block_names=None):
+    """
+    Yield the data blocks in the given mmCIF file one at a time.
+
+    Arguments:
+        path:
+            The path to an mmCIF file, optionally compressed with gzip.
+
+        block_names:
+            If given, only yield blocks with these names.  Other blocks are 
+            skipped without being parsed.
+
+    Unlike `gemmi.cif.read()`, this function never holds more than one block 
+    in memory at a time.  This is useful for big files with lots of small 
+    blocks, like the chemical component dictionary.  The file is split into 
+    blocks by looking for lines that begin with ``data_`` (and that aren't 
+    part of a multi-line text field), then each block is parsed separately.
+    """
+    from gemmi.cif import read_string
+
+    if str(path).endswith('.gz'):
+        import gzip
+        open_cif = gzip.open
+    else:
+        open_cif = open
+
+    def parse_block(lines):
+        return read_string(''.join(lines)).sole_block()
+
+    with open_cif(path, 'rt') as f:
+        # Anything before the first block (e.g. comments) is ignored, as are 
+        # blocks that weren't requested.
+        lines = None
+        in_text_field = False
+
+        for line in f:
+            if line.startswith(';'):
+                in_text_field = not in_text_field
+
+            elif not in_text_field and line[:5].lower() == 'data_':
+                if lines is not None:
+                    yield parse_block(lines)
+
+                name = line[5:].strip()
+                if block_names is None or name in block_names:
+                    lines = []
+                else:
+                    lines = None
+
+            if lines is not None:
+                lines.append(line)
+
+        if lines is not None:
+            yield parse_block(lines)
+
 def extract_dataframe(
         cif,
         key_prefix,
         *,
         required_cols=None,
         optional_cols=None,
+        schema=None,
+        strict=True,
 ):
-    # Gemmi automatically interprets `?` and `.`, but this leads to a few 
+    """
+    Extract the given columns from the given mmCIF category.
+
+    Arguments:
+        cif:
+            The mmCIF data block to extract data from.
+
+        key_prefix:
+            The name of the category to extract, without the leading 
+            underscore or the trailing period, e.g. ``'atom_site'``.
+
+        required_cols:
+            Columns that must be present in the category, if the category is 
+            present at all.  An `IngestError` will be raised if any are 
+            missing.
+
+        optional_cols:
+            Columns that will be filled with nulls if they aren't present.
+
+        schema:
+            A mapping from column names to polars dtypes.  Columns not in this 
+            mapping will be strings.  The conversion is done in bulk, so it's 
+            much faster than casting each value individually.  Note that `?` 
+            and `.` always become null, regardless of dtype.
+
+        strict:
+            If false, values that can't be converted to the requested dtype 
+            will become null.  Otherwise, an exception will be raised.
+
+    Returns:
+        A data frame with one column for each required and optional column, 
+        in that order.  Rows that are entirely null are removed.
+    """
+
+    # Gemmi can automatically interpret `?` and `.`, but this leads to a few 
     # problems.  First is that it makes column dtypes dependent on the data; if 
     # a column doesn't have any non-null values, polars won't know that it 
     # should be a string.  Second is that gemmi distinguishes between `?` 
     # (null) and `.` (false).  This is a particularly unhelpful distinction 
     # when the column in question is supposed to contain float data, because 
     # the latter then becomes 0 rather than null.
+    #
+    # Instead, only the requested columns are read, as raw strings, and all 
+    # the unquoting and null handling happens in polars.  This matters most 
+    # for the `_atom_site` category, which has dozens of columns and can have 
+    # millions of rows.  Converting all of those values into python objects 
+    # used to be the memory bottleneck when ingesting large structures.
 
     pdb_id = cif.name.lower()
+    expected_cols = list(chain(
+        required_cols or [],
+        optional_cols or [],
+    ))
+    dtypes = {
+            col: (schema or {}).get(col, str)
+            for col in expected_cols
+    }
 
     try:
         df = MANUAL_CORRECTIONS[pdb_id, key_prefix]
+        present_cols = df.columns
+        df = df.select(
+                pl.col(col).cast(dtype, strict=strict)
+                for col, dtype in dtypes.items()
+                if col in present_cols
+        )
     except KeyError:
-        loop = {
-                k: [v if isinstance(v, str) else None for v in vs]
-                for k, vs in cif.get_mmcif_category(f'_{key_prefix}.').items()
-        }
-        df = pl.DataFrame(loop, {k: str for k in loop})
+        df, present_cols = _extract_raw_columns(
+                cif, key_prefix, dtypes, strict,
+        )
 
-    expected_cols = list(chain(
-        required_cols or [],
-        optional_cols or [],
-    ))
+    def empty_dataframe():
+        return pl.DataFrame([], dtypes)
 
-    if df.is_empty():
-        schema = {col: str for col in expected_cols}
-        return pl.DataFrame([], schema)
+    if not present_cols:
+        return empty_dataframe()
 
     if required_cols:
-        missing_cols = [x for x in required_cols if x not in df.columns]
+        missing_cols = [x for x in required_cols if x not in present_cols]
         if missing_cols:
             err = IngestError(
                     category=key_prefix,
@@ -56,9 +162,12 @@ def extract_dataframe(
             err.blame += "missing column(s): {missing_cols}"
             raise err
 
+    if df.width == 0:
+        return empty_dataframe()
+
     if optional_cols:
         df = df.with_columns([
-            pl.lit(None, dtype=str).alias(col)
+            pl.lit(None, dtype=dtypes[col]).alias(col)
             for col in optional_cols
             if col not in df.columns
         ])
@@ -69,6 +178,45 @@ def extract_dataframe(
             .filter(~pl.all_horizontal(pl.all().is_null()))
     )
 
+def _extract_raw_columns(cif, key_prefix, dtypes, strict):
+    table = cif.find_mmcif_category(f'_{key_prefix}.')
+    present_cols = [tag.split('.', 1)[1] for tag in table.tags]
+
+    raw_cols = {
+            col: list(cif.find_values(f'_{key_prefix}.{col}'))
+            for col in dtypes
+            if col in present_cols
+    }
+    df = (
+            pl.DataFrame(raw_cols, {k: str for k in raw_cols})
+            .select(
+                _parse_raw_col(k, dtypes[k], strict)
+                for k in raw_cols
+            )
+    )
+    return df, present_cols
+
+def _parse_raw_col(col, dtype, strict):
+    # This should match what `gemmi.cif.as_string()` does, except that `?` and 
+    # `.` both become null.
+    raw = pl.col(col)
+    return (
+            pl.when(raw.is_in(['?', '.']))
+            .then(None)
+            .when(raw.str.starts_with("'") | raw.str.starts_with('"'))
+            .then(raw.str.slice(1, raw.str.len_chars() - 2))
+            .when(raw.str.starts_with(';'))
+            .then(
+                raw
+                .str.slice(1)
+                .str.strip_suffix('\n;')
+                .str.strip_suffix('\r')
+            )
+            .otherwise(raw)
+            .cast(dtype, strict=strict)
+            .alias(col)
+    )
+
 class tquiet:
     """
     Mimic the `tqdm` progress bar interface, but don't actually display 
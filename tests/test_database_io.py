@@ -378,6 +378,32 @@ def test_insert_clashscore():
             ),
     ]
 
+def test_insert_clashscores():
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    insert_1abc(db)
+    insert_9xyz(db)
+
+    clashscores = pl.DataFrame([
+        dict(struct_id=1, source='mmcif_pdbx_vrpt', clashscore=27.2),
+        dict(struct_id=2, source='mmcif_pdbx_vrpt', clashscore=None),
+    ])
+    mmc.insert_clashscores(db, clashscores)
+
+    assert mmc.select_clashscores(db).to_dicts() == [
+            dict(
+                struct_id=1,
+                source='mmcif_pdbx_vrpt',
+                clashscore=approx(27.2),
+            ),
+            dict(
+                struct_id=2,
+                source='mmcif_pdbx_vrpt',
+                clashscore=None,
+            ),
+    ]
+
 def test_insert_entity_clusters():
     db = mmc.open_db(':memory:')
     mmc.init_db(db)
@@ -405,3 +431,72 @@ def test_insert_entity_clusters():
         dict(entity_id=3, cluster_id=2),
         dict(entity_id=4, cluster_id=2),
     ]
+
+def test_insert_structures():
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    def struct(pdb_id, subchain_ids):
+        return dict(
+                pdb_id=pdb_id,
+                exptl_methods=['X-RAY DIFFRACTION'],
+                deposit_date=None,
+                full_atom=True,
+
+                assemblies=pl.DataFrame([
+                    dict(id='1', type=None, polymer_count=1),
+                ]),
+                assembly_subchains=pl.DataFrame([
+                    dict(assembly_id='1', subchain_id=x)
+                    for x in subchain_ids
+                ]),
+                subchains=pl.DataFrame([
+                    dict(id=x, chain_id=x, entity_id='1')
+                    for x in subchain_ids
+                ]),
+                entities=pl.DataFrame([
+                    dict(id='1', type='polymer', formula_weight_Da=None),
+                ]),
+                polymer_entities=pl.DataFrame([
+                    dict(entity_id='1', type='polypeptide(L)', sequence=None),
+                ]),
+        )
+
+    assert mmc.insert_structures(db, []) == []
+
+    # The subchains are given out of order, to make sure that the primary keys 
+    # are assigned in the same order as `insert_structure()` would.
+    struct_ids = mmc.insert_structures(db, [
+        struct('1abc', ['B', 'A']),
+        struct('2abc', ['A']),
+    ])
+    assert struct_ids == [1, 2]
+
+    # Make sure that primary keys from later batches don't collide with those 
+    # from earlier batches.
+    struct_id = mmc.insert_structure(db, **struct('3abc', ['A']))
+    assert struct_id == 3
+
+    assert mmc.select_chains(db).to_dicts() == [
+            dict(id=1, struct_id=1, pdb_id='A'),
+            dict(id=2, struct_id=1, pdb_id='B'),
+            dict(id=3, struct_id=2, pdb_id='A'),
+            dict(id=4, struct_id=3, pdb_id='A'),
+    ]
+    assert mmc.select_entities(db).to_dicts() == [
+            dict(id=1, struct_id=1, pdb_id='1', type='polymer', formula_weight_Da=None),
+            dict(id=2, struct_id=2, pdb_id='1', type='polymer', formula_weight_Da=None),
+            dict(id=3, struct_id=3, pdb_id='1', type='polymer', formula_weight_Da=None),
+    ]
+    assert mmc.select_subchains(db).to_dicts() == [
+            dict(id=1, chain_id=1, entity_id=1, pdb_id='A'),
+            dict(id=2, chain_id=2, entity_id=1, pdb_id='B'),
+            dict(id=3, chain_id=3, entity_id=2, pdb_id='A'),
+            dict(id=4, chain_id=4, entity_id=3, pdb_id='A'),
+    ]
+    assert mmc.select_assembly_subchains(db).to_dicts() == [
+            dict(assembly_id=1, subchain_id=1),
+            dict(assembly_id=1, subchain_id=2),
+            dict(assembly_id=2, subchain_id=3),
+            dict(assembly_id=3, subchain_id=4),
+    ]
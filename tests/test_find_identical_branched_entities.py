@@ -1,6 +1,9 @@
+import polars as pl
 import networkx as nx
 import macromol_census as mmc
 
+from pytest import mark
+
 def make_branched_entity_graph(entity_id, *edges):
     g = nx.Graph(entity_id=entity_id)
 
@@ -19,6 +22,144 @@ def make_branched_entity_graph(entity_id, *edges):
 
     return g
 
+def make_labeled_graph(nodes, edges):
+    g = nx.Graph()
+
+    for node, label in nodes.items():
+        g.add_node(node, label=label)
+    for node_1, node_2, label in edges:
+        g.add_edge(node_1, node_2, label=label)
+
+    return g
+
+def insert_branched_entities(db, pdb_id, *entity_bonds):
+    n = len(entity_bonds)
+    ids = [str(i + 1) for i in range(n)]
+    bonds = []
+
+    for entity_id, entity_bonds_i in zip(ids, entity_bonds):
+        for seq_1, comp_1, atom_1, seq_2, comp_2, atom_2 in entity_bonds_i:
+            bonds.append(dict(
+                entity_id=entity_id,
+                seq_id_1=seq_1, comp_id_1=comp_1, atom_id_1=atom_1,
+                seq_id_2=seq_2, comp_id_2=comp_2, atom_id_2=atom_2,
+                bond_order='sing',
+            ))
+
+    mmc.insert_structure(
+            db, pdb_id,
+            exptl_methods=[],
+            deposit_date=None,
+            full_atom=True,
+
+            assemblies=pl.DataFrame([
+                dict(id='1', type='author_defined_assembly', polymer_count=0),
+            ]),
+            assembly_subchains=pl.DataFrame([
+                dict(assembly_id='1', subchain_id=id)
+                for id in ids
+            ]),
+            subchains=pl.DataFrame([
+                dict(id=id, chain_id=id, entity_id=id)
+                for id in ids
+            ]),
+            entities=pl.DataFrame([
+                dict(id=id, type='branched', formula_weight_Da=None)
+                for id in ids
+            ]),
+            branched_entities=pl.DataFrame([
+                dict(entity_id=id, type='oligosaccharide')
+                for id in ids
+            ]),
+            branched_entity_bonds=pl.DataFrame(bonds),
+    )
+
+NAG_NAG_BMA = [
+        ('2', 'NAG', 'C1', '1', 'NAG', 'O4'),
+        ('3', 'BMA', 'C1', '2', 'NAG', 'O4'),
+]
+NAG_NAG_BMA_RENUMBERED = [
+        ('1', 'BMA', 'C1', '2', 'NAG', 'O4'),
+        ('3', 'NAG', 'O4', '2', 'NAG', 'C1'),
+]
+NAG_NAG_BMA_1_6 = [
+        ('2', 'NAG', 'C1', '1', 'NAG', 'O4'),
+        ('3', 'BMA', 'C1', '2', 'NAG', 'O6'),
+]
+
+@mark.parametrize('jobs', [1, 2])
+def test_find_identical_branched_entities(jobs):
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    insert_branched_entities(
+            db, '1abc',
+            NAG_NAG_BMA,
+
+            # Same as 1, but numbered and listed differently.
+            NAG_NAG_BMA_RENUMBERED,
+
+            # Different linkage than 1.
+            NAG_NAG_BMA_1_6,
+    )
+
+    clusters = mmc.find_identical_branched_entities(db, jobs=jobs)
+
+    assert clusters.sort('entity_id').to_dicts() == [
+            dict(entity_id=1, cluster_id=1),
+            dict(entity_id=2, cluster_id=1),
+            dict(entity_id=3, cluster_id=2),
+    ]
+
+def test_find_identical_branched_entities_cache():
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    insert_branched_entities(
+            db, '1abc',
+            NAG_NAG_BMA,
+            NAG_NAG_BMA_RENUMBERED,
+    )
+
+    clusters = mmc.find_identical_branched_entities(db)
+
+    assert clusters.sort('entity_id').to_dicts() == [
+            dict(entity_id=1, cluster_id=1),
+            dict(entity_id=2, cluster_id=1),
+    ]
+
+    # Different bond lists get different digests, even if they have the same 
+    # cluster key.
+    keys = mmc.select_branched_entity_cluster_keys(db)
+    assert keys.height == 2
+    assert keys['cluster_key'].n_unique() == 1
+
+    # Pretend that 1-6 linkages were previously given the same cluster key as 
+    # 1-4 linkages.  The cached key should be used without recalculating it.
+    insert_branched_entities(
+            db, '2abc',
+            NAG_NAG_BMA_1_6,
+    )
+    digests = mmc.select_branched_entity_bond_digests(db)
+
+    assert digests['cluster_key'].null_count() == 1
+
+    fake_keys = (
+            digests
+            .filter(pl.col('cluster_key').is_null())
+            .with_columns(cluster_key=pl.lit(keys['cluster_key'][0]))
+    )
+    mmc.insert_branched_entity_cluster_keys(db, fake_keys)
+
+    clusters = mmc.find_identical_branched_entities(db)
+
+    assert clusters.sort('entity_id').to_dicts() == [
+            dict(entity_id=1, cluster_id=1),
+            dict(entity_id=2, cluster_id=1),
+            dict(entity_id=3, cluster_id=1),
+    ]
+    assert mmc.select_branched_entity_cluster_keys(db).height == 3
+
 def test_cluster_isomorphic_graphs():
     entities = [
             make_branched_entity_graph(
@@ -58,3 +199,75 @@ def test_cluster_isomorphic_graphs():
             dict(entity_id=4, cluster_id=3),
             dict(entity_id=5, cluster_id=4),
     ]
+
+@mark.parametrize('jobs', [1, 2])
+def test_cluster_isomorphic_graphs_cycles(jobs):
+    # Cyclic graphs (e.g. cyclodextrins) don't have canonical strings, so 
+    # they're compared in a different way.  Make sure that cluster ids are 
+    # still assigned in order of first appearance.
+    def cycle(entity_id, labels):
+        n = len(labels)
+        g = make_labeled_graph(
+                dict(enumerate(labels)),
+                [(i, (i + 1) % n, None) for i in range(n)],
+        )
+        g.graph['entity_id'] = entity_id
+        return g
+
+    entities = [
+            cycle(1, 'AAB'),
+            make_branched_entity_graph(
+                2,
+                (1, 'ABC', 'C1', 2, 'XYZ', 'O3', 'sing'),
+            ),
+            cycle(3, 'BAA'),
+            cycle(4, 'ABB'),
+    ]
+
+    assert mmc.cluster_isomorphic_graphs(entities, jobs=jobs).to_dicts() == [
+            dict(entity_id=1, cluster_id=1),
+            dict(entity_id=3, cluster_id=1),
+            dict(entity_id=2, cluster_id=2),
+            dict(entity_id=4, cluster_id=3),
+    ]
+
+def test_canonicalize_labeled_tree():
+    # A branched tree, with the nodes numbered in two different ways:
+    g1 = make_labeled_graph(
+            {1: 'A', 2: 'B', 3: 'C', 4: 'C', 5: 'D'},
+            [(1, 2, 'x'), (2, 3, 'y'), (2, 4, 'z'), (4, 5, 'x')],
+    )
+    g2 = make_labeled_graph(
+            {5: 'A', 4: 'B', 3: 'C', 2: 'C', 1: 'D'},
+            [(3, 4, 'y'), (1, 2, 'x'), (4, 5, 'x'), (2, 4, 'z')],
+    )
+
+    # Same as above, but with the edge labels on the two branches swapped:
+    g3 = make_labeled_graph(
+            {1: 'A', 2: 'B', 3: 'C', 4: 'C', 5: 'D'},
+            [(1, 2, 'x'), (2, 3, 'z'), (2, 4, 'y'), (4, 5, 'x')],
+    )
+
+    # A path with two centers:
+    g4 = make_labeled_graph(
+            {1: 'A', 2: 'B', 3: 'B', 4: 'A'},
+            [(1, 2, None), (2, 3, None), (3, 4, None)],
+    )
+
+    # A cycle:
+    g5 = make_labeled_graph(
+            {1: 'A', 2: 'A', 3: 'A'},
+            [(1, 2, None), (2, 3, None), (3, 1, None)],
+    )
+
+    c1 = mmc.canonicalize_labeled_tree(g1)
+    c2 = mmc.canonicalize_labeled_tree(g2)
+    c3 = mmc.canonicalize_labeled_tree(g3)
+    c4 = mmc.canonicalize_labeled_tree(g4)
+    c5 = mmc.canonicalize_labeled_tree(g5)
+
+    assert c1 == c2
+    assert c1 != c3
+    assert c4 == mmc.canonicalize_labeled_tree(nx.relabel_nodes(g4, {1: 4, 4: 1}))
+    assert c5 is None
+    assert mmc.canonicalize_labeled_tree(nx.Graph()) == ''
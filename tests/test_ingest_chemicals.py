@@ -1,5 +1,5 @@
 import macromol_census as mmc
-from gemmi.cif import read as read_cif
+from gemmi.cif import read as read_cif, read_string as read_cif_string
 from pathlib import Path
 
 CIF_DIR = Path(__file__).parent / 'pdb'
@@ -20,3 +20,65 @@ def test_ingest_chemicals():
     ]
 
     
+
+def test_ingest_chemicals_chunks():
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    cif = read_cif_string('''\
+data_AAA
+loop_
+_pdbx_chem_comp_descriptor.type
+_pdbx_chem_comp_descriptor.descriptor
+InChI    InChI=A
+InChIKey A-KEY
+data_BBB
+_pdbx_chem_comp_descriptor.type       SMILES
+_pdbx_chem_comp_descriptor.descriptor C
+data_CCC
+loop_
+_pdbx_chem_comp_descriptor.type
+_pdbx_chem_comp_descriptor.descriptor
+InChI    InChI=C
+InChIKey C-KEY
+''')
+    mmc.ingest_chemical_components(db, cif, chunk_size=2)
+
+    assert mmc.select_chemical_components(db).to_dicts() == [
+            dict(pdb_id='AAA', inchi='InChI=A', inchi_key='A-KEY'),
+            dict(pdb_id='BBB', inchi=None, inchi_key=None),
+            dict(pdb_id='CCC', inchi='InChI=C', inchi_key='C-KEY'),
+    ]
+
+def test_ingest_chemicals_iter_blocks():
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    blocks = mmc.iter_cif_blocks(CIF_DIR / 'components.cif.gz')
+    mmc.ingest_chemical_components(db, blocks)
+
+    assert mmc.select_chemical_components(db)['pdb_id'].to_list() == ['EQU']
+
+def test_ingest_chemicals_used_only():
+    from test_database_io import insert_1abc
+
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    insert_1abc(db)
+
+    def ingest_used_components():
+        blocks = mmc.iter_cif_blocks(
+                CIF_DIR / 'components.cif.gz',
+                block_names=mmc.select_used_component_ids(db),
+        )
+        mmc.ingest_chemical_components(db, blocks)
+
+    ingest_used_components()
+    assert mmc.select_chemical_components(db).is_empty()
+
+    db.execute("INSERT INTO entity_monomer VALUES (1, 'EQU'), (1, 'EQU')")
+    assert mmc.select_used_component_ids(db) == {'EQU'}
+
+    ingest_used_components()
+    assert mmc.select_chemical_components(db)['pdb_id'].to_list() == ['EQU']
@@ -1,7 +1,9 @@
 import polars as pl
 import macromol_census as mmc
+import shutil
+import os
 
-from pytest import approx
+from pytest import approx, raises, mark
 from pytest_unordered import unordered
 from polars.testing import assert_frame_equal
 from functools import partial
@@ -12,6 +14,48 @@ CIF_DIR = Path(__file__).parent / 'pdb'
 
 assert_frame_equal = partial(assert_frame_equal, check_dtypes=False)
 
+def test_find_cif_paths(tmp_path):
+    for path in [
+            'ab/1abc.cif.gz',
+            'ab/2abd.cif',
+            'ab/README',
+            'xy/9xyz.cif.gz',
+            'xy/nested/8xyz.cif.gz',
+            '7xyz.cif.gz',
+    ]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).touch()
+
+    assert list(mmc.find_cif_paths(tmp_path)) == [
+            tmp_path / 'ab/1abc.cif.gz',
+            tmp_path / 'ab/2abd.cif',
+            tmp_path / 'xy/9xyz.cif.gz',
+    ]
+
+def test_read_manifest(tmp_path):
+    import gzip, json
+
+    txt_path = tmp_path / 'manifest.txt'
+    txt_path.write_text("""\
+# comment
+1ABC
+
+xy/9xyz.cif
+""")
+    assert mmc.read_manifest(txt_path, 'pdb') == [
+            Path('pdb/ab/1abc.cif.gz'),
+            Path('pdb/xy/9xyz.cif'),
+    ]
+
+    json_path = tmp_path / 'current_file_holdings.json.gz'
+    with gzip.open(json_path, 'wt') as f:
+        json.dump({'1abc': {'mmcif': []}, '9xyz': {'mmcif': []}}, f)
+
+    assert mmc.read_manifest(json_path, 'pdb') == [
+            Path('pdb/ab/1abc.cif.gz'),
+            Path('pdb/xy/9xyz.cif.gz'),
+    ]
+
 def test_find_uningested_paths():
     db = mmc.open_db(':memory:')
     mmc.init_db(db)
@@ -27,6 +71,157 @@ def test_find_uningested_paths():
 
     assert uningested_paths == ['9xyz']
 
+def test_update_structures(tmp_path):
+    def pdb_id_from_path(p):
+        return p.name.split('.')[0]
+
+    def copy_cif(pdb_id):
+        path = tmp_path / f'{pdb_id}.cif.gz'
+        shutil.copy(CIF_DIR / f'{pdb_id}.cif.gz', path)
+        return path
+
+    def select_pdb_ids(db):
+        return mmc.select_structures(db)['pdb_id'].to_list()
+
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    path_4erd = copy_cif('4erd')
+    path_2g10 = copy_cif('2g10')
+    path_146d = copy_cif('146d')
+
+    mmc.update_structures(
+            db, [path_4erd, path_2g10, path_146d],
+            pdb_id_from_path=pdb_id_from_path,
+    )
+    mmc.insert_blacklisted_structures(db, pl.DataFrame({'pdb_id': ['2g10']}))
+
+    assert select_pdb_ids(db) == ['4erd', '2g10', '146d']
+    assert mmc.select_structure_files(db)['struct_id'].to_list() == [1, 2, 3]
+
+    # Nothing has changed, so nothing should happen.
+    cif_paths, stale_struct_ids = mmc.find_updated_paths(
+            db, [path_4erd, path_2g10, path_146d],
+            pdb_id_from_path=pdb_id_from_path,
+    )
+    assert cif_paths == []
+    assert stale_struct_ids == []
+
+    # Revise 2g10, obsolete 146d, and release 2iy3.
+    st = path_2g10.stat()
+    os.utime(path_2g10, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    path_146d.unlink()
+    path_2iy3 = copy_cif('2iy3')
+
+    cif_paths, stale_struct_ids = mmc.find_updated_paths(
+            db, [path_4erd, path_2g10, path_2iy3],
+            pdb_id_from_path=pdb_id_from_path,
+    )
+    assert cif_paths == [path_2g10, path_2iy3]
+    assert stale_struct_ids == [2, 3]
+
+    mmc.update_structures(
+            db, [path_4erd, path_2g10, path_2iy3],
+            pdb_id_from_path=pdb_id_from_path,
+            batch_size=2,
+    )
+
+    assert select_pdb_ids(db) == ['4erd', '2g10', '2iy3']
+    assert mmc.select_structures(db)['id'].to_list() == [1, 4, 5]
+    assert mmc.select_structure_files(db).to_dicts() == [
+            dict(
+                struct_id=x,
+                size_bytes=p.stat().st_size,
+                mtime_ns=p.stat().st_mtime_ns,
+            )
+            for x, p in [(1, path_4erd), (4, path_2g10), (5, path_2iy3)]
+    ]
+    assert mmc.select_blacklisted_structures(db).to_dicts() == [
+            dict(struct_id=4),
+    ]
+
+    # Make sure there aren't any orphaned rows left over from the deleted 
+    # structures.
+    assert set(mmc.select_chains(db)['struct_id']) == {1, 4, 5}
+    assert set(mmc.select_entities(db)['struct_id']) == {1, 4, 5}
+    assert set(mmc.select_assemblies(db)['struct_id']) == {1, 4, 5}
+
+def test_update_structures_err(tmp_path):
+    # If a revised structure can't be re-ingested, its blacklist entry should 
+    # be restored whenever it eventually is re-ingested.
+
+    def pdb_id_from_path(p):
+        return p.name.split('.')[0]
+
+    def select_blacklisted_pdb_ids(db):
+        return (
+                mmc.select_blacklisted_structures(db)
+                .join(mmc.select_structures(db), left_on='struct_id', right_on='id')
+                .get_column('pdb_id')
+                .to_list()
+        )
+
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    path_2g10 = tmp_path / '2g10.cif.gz'
+    shutil.copy(CIF_DIR / '2g10.cif.gz', path_2g10)
+
+    mmc.update_structures(db, [path_2g10], pdb_id_from_path=pdb_id_from_path)
+    mmc.insert_blacklisted_structures(db, pl.DataFrame({'pdb_id': ['2g10']}))
+
+    assert select_blacklisted_pdb_ids(db) == ['2g10']
+
+    path_2g10.write_bytes(b'corrupt')
+
+    with raises(mmc.IngestError):
+        mmc.update_structures(
+                db, [path_2g10],
+                pdb_id_from_path=pdb_id_from_path,
+        )
+
+    assert mmc.select_structures(db).is_empty()
+    assert mmc.select_pending_blacklisted_structures(db).to_dicts() == [
+            dict(pdb_id='2g10'),
+    ]
+
+    shutil.copy(CIF_DIR / '2g10.cif.gz', path_2g10)
+    mmc.update_structures(db, [path_2g10], pdb_id_from_path=pdb_id_from_path)
+
+    assert select_blacklisted_pdb_ids(db) == ['2g10']
+    assert mmc.select_pending_blacklisted_structures(db).is_empty()
+
+def test_update_structures_skip_huge(tmp_path):
+    def pdb_id_from_path(p):
+        return p.name.split('.')[0]
+
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    path_4erd = tmp_path / '4erd.cif.gz'
+    shutil.copy(CIF_DIR / '4erd.cif.gz', path_4erd)
+
+    mmc.update_structures(db, [path_4erd], pdb_id_from_path=pdb_id_from_path)
+
+    # Make the file huge (without actually using any disk space).  It's 
+    # changed, but since it's also huge, it should be left alone.
+    os.truncate(path_4erd, 50_000_000)
+
+    cif_paths, stale_struct_ids = mmc.find_updated_paths(
+            db, [path_4erd],
+            pdb_id_from_path=pdb_id_from_path,
+            skip_huge=True,
+    )
+    assert cif_paths == []
+    assert stale_struct_ids == []
+
+    cif_paths, stale_struct_ids = mmc.find_updated_paths(
+            db, [path_4erd],
+            pdb_id_from_path=pdb_id_from_path,
+    )
+    assert cif_paths == [path_4erd]
+    assert stale_struct_ids == [1]
+
 def test_ingest_mmcif_4erd():
     # 4erd is an interesting model, because it's one of the few examples in the 
     # PDB where a single chain (an RNA double helix, in this case) appears in 
@@ -1016,6 +1211,114 @@ def test_ingest_mmcif_6igg():
     assert mmc.select_nmr_representatives(db).is_empty()
     assert mmc.select_em_quality(db).is_empty()
 
+@mark.parametrize(
+        'kwargs', [
+            dict(jobs=2),
+            dict(batch_size=2),
+            dict(batch_size=10),
+            dict(jobs=2, batch_size=2),
+        ]
+)
+def test_ingest_structures_jobs_batches(kwargs):
+    # Parsing in worker processes and inserting in batches should both give 
+    # exactly the same database as parsing and inserting one structure at a 
+    # time, including the primary keys.
+
+    cif_paths = [
+            CIF_DIR / '4erd.cif.gz',
+            CIF_DIR / '2g10.cif.gz',
+            CIF_DIR / '146d.cif.gz',
+            CIF_DIR / '2iy3.cif.gz',
+    ]
+
+    def ingest(**kwargs):
+        db = mmc.open_db(':memory:')
+        mmc.init_db(db)
+        mmc.ingest_structures(db, cif_paths, **kwargs)
+        return db
+
+    db_1 = ingest()
+    db_2 = ingest(**kwargs)
+
+    for select in [
+            mmc.select_structures,
+            mmc.select_models,
+            mmc.select_chains,
+            mmc.select_entities,
+            mmc.select_subchains,
+            mmc.select_assemblies,
+            mmc.select_assembly_subchains,
+            mmc.select_polymer_entities,
+            mmc.select_branched_entities,
+            mmc.select_branched_entity_bonds,
+            mmc.select_monomer_entities,
+            mmc.select_xtal_quality,
+            mmc.select_nmr_representatives,
+            mmc.select_em_quality,
+    ]:
+        assert_frame_equal(select(db_1), select(db_2))
+
+def test_ingest_structures_batch_err():
+    # If a batch can't be inserted, the structures should be retried one at a 
+    # time, and only the structure that actually fails should be reported.
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    mmc.ingest_structures(db, [CIF_DIR / '4erd.cif.gz'])
+
+    with raises(mmc.IngestError) as err:
+        mmc.ingest_structures(
+                db, [CIF_DIR / '2g10.cif.gz', CIF_DIR / '4erd.cif.gz'],
+                batch_size=2,
+        )
+
+    assert str(CIF_DIR / '4erd.cif.gz') in str(err.value)
+    assert str(CIF_DIR / '2g10.cif.gz') not in str(err.value)
+    assert mmc.select_structures(db)['pdb_id'].to_list() == ['4erd', '2g10']
+
+def test_ingest_structures_batch_retry(monkeypatch):
+    # If every structure can be inserted on its own, retrying a failed batch 
+    # shouldn't raise an error.
+    #
+    # The `ingest_structures()` function shadows the module of the same name, 
+    # so the module has to be looked up directly.
+    import sys
+    mmcs = sys.modules['macromol_census.ingest_structures']
+
+    insert_structures = mmcs._insert_structures
+
+    def insert_structures_one_at_a_time(db, batch, stats):
+        if len(batch) > 1:
+            raise RuntimeError("batch failed")
+        insert_structures(db, batch, stats)
+
+    monkeypatch.setattr(
+            mmcs, '_insert_structures', insert_structures_one_at_a_time,
+    )
+
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    mmc.ingest_structures(
+            db, [CIF_DIR / '4erd.cif.gz', CIF_DIR / '2g10.cif.gz'],
+            batch_size=2,
+    )
+
+    assert mmc.select_structures(db)['pdb_id'].to_list() == ['4erd', '2g10']
+
+def test_ingest_structures_jobs_err(tmp_path):
+    cif_path = tmp_path / '9xyz.cif'
+    cif_path.write_text('data_9XYZ\n_exptl.method "X-RAY DIFFRACTION"\n')
+
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    with raises(mmc.IngestError) as err:
+        mmc.ingest_structures(db, [cif_path], jobs=2)
+
+    assert str(cif_path) in str(err.value)
+    assert mmc.select_structures(db).is_empty()
+
 def test_find_subchains():
     from macromol_census.ingest_structures import _find_subchains
 
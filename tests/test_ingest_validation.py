@@ -2,7 +2,7 @@ import macromol_census as mmc
 import macromol_census.ingest_validation as mmci
 
 from gemmi.cif import read as read_cif
-from pytest import approx
+from pytest import approx, mark
 from pathlib import Path
 
 CIF_DIR = Path(__file__).parent / 'pdb'
@@ -76,3 +76,91 @@ def test_ingest_validation_report_2wls():
                 clashscore=approx(11.03),
             ),
     ]
+
+def test_ingest_validation_reports_resume():
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+    db.executemany(
+            'INSERT INTO structure (pdb_id, full_atom) VALUES (?, TRUE)',
+            [('6dze',), ('4iio',), ('2wls',)],
+    )
+
+    def find_uningested(cif_paths):
+        return mmc.find_uningested_validation_reports(
+                db, cif_paths,
+                pdb_id_from_path=lambda p: p.name.split('_')[0],
+        )
+
+    cif_paths = [
+            CIF_DIR / '6dze_validation.cif.gz',
+            CIF_DIR / '4iio_validation.cif.gz',
+            CIF_DIR / '2wls_validation.cif.gz',
+    ]
+
+    # Pretend that the program was interrupted after the first two reports.  
+    # The 4iio report doesn't have any quality data, but it should still be 
+    # recorded as having been ingested.
+    mmc.ingest_validation_reports(db, cif_paths[:2], checkpoint_size=1)
+
+    assert mmc.select_quality_sources(db).to_dicts() == [
+            dict(struct_id=1, source='mmcif_pdbx_vrpt'),
+            dict(struct_id=2, source='mmcif_pdbx_vrpt'),
+    ]
+    assert find_uningested(cif_paths) == cif_paths[2:]
+
+    mmc.ingest_validation_reports(db, find_uningested(cif_paths))
+
+    assert find_uningested(cif_paths) == []
+    assert mmc.select_quality_sources(db)['struct_id'].to_list() == [1, 2, 3]
+    assert mmc.select_clashscores(db)['struct_id'].to_list() == [1, 3]
+
+@mark.parametrize('jobs', [1, 2])
+def test_ingest_validation_reports_jobs(jobs):
+    pdb_ids = ['2wls', '4iio', '6dze', '6dzp', '6eri', '8dzr']
+
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+    db.executemany(
+            'INSERT INTO structure (pdb_id, full_atom) VALUES (?, TRUE)',
+            [(x,) for x in pdb_ids],
+    )
+
+    mmc.ingest_validation_reports(
+            db, [CIF_DIR / f'{x}_validation.cif.gz' for x in pdb_ids],
+            checkpoint_size=4,
+            jobs=jobs,
+    )
+
+    assert mmc.select_quality_sources(db)['struct_id'].to_list() == \
+            [1, 2, 3, 4, 5, 6]
+    assert mmc.select_nmr_quality(db).to_dicts() == [
+            dict(struct_id=3, source='mmcif_pdbx_vrpt', num_dist_restraints=162),
+    ]
+
+def test_ingest_validation_reports_batch_retry(monkeypatch):
+    # If every report can be inserted on its own, retrying a failed batch 
+    # shouldn't raise an error.
+    insert_reports = mmci._insert_reports
+
+    def insert_reports_one_at_a_time(db, batch):
+        if len(batch) > 1:
+            raise RuntimeError("batch failed")
+        insert_reports(db, batch)
+
+    monkeypatch.setattr(mmci, '_insert_reports', insert_reports_one_at_a_time)
+
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+    db.executemany(
+            'INSERT INTO structure (pdb_id, full_atom) VALUES (?, TRUE)',
+            [('6dze',), ('2wls',)],
+    )
+
+    mmc.ingest_validation_reports(
+            db, [
+                CIF_DIR / '6dze_validation.cif.gz',
+                CIF_DIR / '2wls_validation.cif.gz',
+            ],
+    )
+
+    assert mmc.select_quality_sources(db)['struct_id'].to_list() == [1, 2]
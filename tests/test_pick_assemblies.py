@@ -3,13 +3,16 @@ import macromol_census as mmc
 import macromol_census.pick_assemblies
 import sys
 
+from itertools import combinations
+from pytest import mark
 from pytest_unordered import unordered
 
 # With just `import macromol_census.pick_assemblies as _mmc`, the function 
 # `pick_assemblies()` ends up shadowing the module of the same name.
 _mmc = sys.modules['macromol_census.pick_assemblies']
 
-def test_pick_assemblies():
+@mark.parametrize('saved_ranked_subchains', [False, True])
+def test_pick_assemblies(saved_ranked_subchains):
     db = mmc.open_db(':memory:')
     mmc.init_db(db)
 
@@ -197,7 +200,7 @@ def test_pick_assemblies():
             'test',
     )
 
-    mmc.pick_assemblies(db)
+    mmc.pick_assemblies(db, saved_ranked_subchains=saved_ranked_subchains)
 
     assert mmc.select_nonredundant_subchains(db).to_dicts() == [
             dict(subchain_id=1),
@@ -211,6 +214,97 @@ def test_pick_assemblies():
             dict(subchain_id_1=8, subchain_id_2=9),
     ]
 
+    if saved_ranked_subchains:
+        ranked_subchains = db.sql('SELECT * FROM ranked_subchain').pl()
+        assert ranked_subchains.equals(_mmc._select_ranked_subchains(db))
+        assert ranked_subchains.schema['struct_id'] == pl.Int32
+        assert ranked_subchains.schema['cluster_id'] == pl.Int32
+
+def test_saved_ranked_subchains_stale():
+    db = make_visit_db()
+
+    def visit():
+        mmc.visit_assemblies(db, RecordingVisitor, saved_ranked_subchains=True)
+        return db.sql('SELECT * FROM ranked_subchain').pl()
+
+    def select_expected():
+        return _mmc._select_ranked_subchains(db)
+
+    assert visit().equals(select_expected())
+    assert _mmc._is_saved_ranked_subchains_current(db)
+
+    # Re-ranking the structures should invalidate the saved table.
+    mmc.update_structure_ranks(
+            db,
+            pl.DataFrame([
+                dict(struct_id=1, rank=3),
+                dict(struct_id=2, rank=2),
+                dict(struct_id=3, rank=1),
+            ]),
+    )
+    assert not _mmc._is_saved_ranked_subchains_current(db)
+    assert visit().equals(select_expected())
+    assert visit()['struct_id'].unique(maintain_order=True).to_list() \
+            == [3, 2, 1]
+
+    # So should deleting a structure.
+    mmc.delete_structures(db, [2])
+    assert not _mmc._is_saved_ranked_subchains_current(db)
+    assert visit().equals(select_expected())
+    assert visit()['struct_id'].unique(maintain_order=True).to_list() \
+            == [3, 1]
+
+@mark.parametrize(
+        'sql', [
+            # Missing column, e.g. from before `assembly_pdb_id` was added:
+            'SELECT * EXCLUDE (assembly_pdb_id) FROM ranked_subchain',
+
+            # Extra column:
+            'SELECT *, 0 AS extra FROM ranked_subchain',
+
+            # Wrong type:
+            'SELECT * REPLACE (struct_id::BIGINT AS struct_id) '
+            'FROM ranked_subchain',
+        ]
+)
+def test_saved_ranked_subchains_schema(sql):
+    db = make_visit_db()
+    mmc.save_ranked_subchains(db)
+
+    # Change the shape of the saved table, without changing the tables it's 
+    # derived from.
+    db.execute(f'CREATE OR REPLACE TABLE ranked_subchain AS {sql}')
+    assert not _mmc._is_saved_ranked_subchains_current(db)
+
+    mmc.visit_assemblies(db, RecordingVisitor, saved_ranked_subchains=True)
+
+    assert _mmc._is_saved_ranked_subchains_current(db)
+    assert db.sql('SELECT * FROM ranked_subchain').pl().equals(
+            _mmc._select_ranked_subchains(db),
+    )
+
+def test_saved_ranked_subchains_order():
+    # The saved table should be visited in rank order, even if its rows aren't 
+    # stored in that order.
+    db = make_visit_db()
+
+    RecordingVisitor.accepted = []
+    mmc.visit_assemblies(db, RecordingVisitor)
+    expected = RecordingVisitor.accepted
+
+    mmc.save_ranked_subchains(db)
+    db.execute('''\
+            CREATE OR REPLACE TABLE ranked_subchain AS
+            SELECT * FROM ranked_subchain
+            ORDER BY struct_rank DESC, subchain_id DESC
+    ''')
+    assert _mmc._is_saved_ranked_subchains_current(db)
+
+    RecordingVisitor.accepted = []
+    mmc.visit_assemblies(db, RecordingVisitor, saved_ranked_subchains=True)
+
+    assert RecordingVisitor.accepted == expected
+
 def test_pick_assemblies_chain():
     db = mmc.open_db(':memory:')
     mmc.init_db(db)
@@ -280,14 +374,10 @@ def test_pick_assemblies_chain():
             dict(subchain_id_1=3, subchain_id_2=4),
     ])
 
-def test_visit_assemblies_memento(tmp_path):
+def make_visit_db():
     db = mmc.open_db(':memory:')
     mmc.init_db(db)
 
-    # `1abc` and `3abc` both have just one assembly, while `2abc` has two.  The 
-    # idea is to stop in the middle of `2abc` (i.e. after its first assembly 
-    # and before its second) and then restart from that point.
-
     mmc.insert_structure(
             db, '1abc',
             exptl_methods=[],
@@ -399,6 +489,15 @@ def test_visit_assemblies_memento(tmp_path):
             'test',
     )
 
+    return db
+
+def test_visit_assemblies_memento(tmp_path):
+    # `1abc` and `3abc` both have just one assembly, while `2abc` has two.  The 
+    # idea is to stop in the middle of `2abc` (i.e. after its first assembly 
+    # and before its second) and then restart from that point.
+
+    db = make_visit_db()
+
     mmc.pick_assemblies(db)
     iterations = 0
     visited_assemblies = []
@@ -455,6 +554,79 @@ def test_visit_assemblies_memento(tmp_path):
             ('3abc', ['1', '2'], '1', ['A']),
     ]
 
+class RecordingVisitor(mmc.Visitor):
+    # This class has to be defined at the module level, so that it can be sent 
+    # to worker processes.
+    accepted = []
+
+    def __init__(self, structure):
+        self.structure = structure
+
+    def propose(self, assembly):
+        subchains = [(x, 0) for x in assembly.subchain_pdb_ids]
+
+        for subchain in subchains:
+            yield mmc.Candidate(subchains=[subchain])
+
+        for pair in combinations(subchains, r=2):
+            yield mmc.Candidate(subchain_pairs=[pair])
+
+    def accept(self, candidates, memento):
+        self.accepted.append((
+            self.structure.pdb_id,
+            self.structure.model_pdb_ids,
+            [(list(c.subchains), list(c.subchain_pairs)) for c in candidates],
+        ))
+
+@mark.parametrize('jobs', [1, 2])
+def test_visit_assemblies_jobs(jobs):
+    db = make_visit_db()
+
+    RecordingVisitor.accepted = []
+    mmc.visit_assemblies(db, RecordingVisitor, jobs=jobs)
+
+    assert RecordingVisitor.accepted == [
+            ('1abc', ['1'], [
+                ([('A', 0)], []),
+                ([('B', 0)], []),
+                ([], [(('A', 0), ('B', 0))]),
+            ]),
+            ('2abc', ['1'], [
+                ([('A', 0)], []),
+            ]),
+            ('2abc', ['1'], []),
+            ('3abc', ['1', '2'], [
+                ([('A', 0)], []),
+            ]),
+    ]
+
+def test_find_redundant_assemblies():
+    # - Assembly 1 is always non-redundant.
+    # - Assembly 2 only has cluster 1, but cluster pair (1,1) hasn't been seen 
+    #   yet, because assembly 1 only has one subchain in cluster 1.
+    # - Assembly 3 is redundant with assembly 2.
+    # - Assembly 4 has a new cluster pair, (2,2).
+    # - Assembly 5 has a new cluster, 3.
+    # - Assembly 6 is redundant with assemblies 1-5.
+
+    def assembly(assembly_id, *cluster_ids):
+        return [
+                dict(assembly_id=assembly_id, cluster_id=x)
+                for x in cluster_ids
+        ]
+
+    ranked_subchains = pl.DataFrame([
+            *assembly(1, 1, 2),
+            *assembly(2, 1, 1),
+            *assembly(3, 1, 1, 1),
+            *assembly(4, 2, 2),
+            *assembly(5, 3),
+            *assembly(6, 1, 1, 2, 2),
+    ])
+
+    redundant = _mmc._find_redundant_assemblies(ranked_subchains)
+    assert redundant['assembly_id'].to_list() == unordered([3, 6])
+
 def test_select_relevant_subchains():
     db = mmc.open_db(':memory:')
     mmc.init_db(db)
@@ -937,7 +1109,8 @@ def test_select_assembly_rank():
     assert _mmc._select_assembly_rank(db, 3) == (1, 1)
     assert _mmc._select_assembly_rank(db, 4) == (1, 2)
 
-def test_accept_nonredundant_subchains():
+@mark.parametrize('set_factory', [set, _mmc._ClusterSet])
+def test_accept_nonredundant_subchains(set_factory):
     # - Empty candidate is ignored, without causing any problems.
     #
     # - (A,0) and (A,1) are excluded because they're part of a cluster that's 
@@ -1004,7 +1177,7 @@ def test_accept_nonredundant_subchains():
 
             'Z': 99,  # make sure unused clusters aren't included.
     }
-    accepted_clusters = {1}
+    accepted_clusters = set_factory({1})
     accepted_candidate_indices = set()
 
     _mmc._accept_nonredundant_subchains(
@@ -1017,7 +1190,8 @@ def test_accept_nonredundant_subchains():
     assert accepted_candidate_indices == {4, 5, 6, 8, 9, 10, 13, 16, 17, 19}
     assert accepted_clusters == {1,2,3,4,5,6,7}
 
-def test_accept_nonredundant_subchain_pairs():
+@mark.parametrize('set_factory', [set, _mmc._ClusterPairSet])
+def test_accept_nonredundant_subchain_pairs(set_factory):
     # - Empty candidate is ignored, without causing any problems.
     #
     # - (A,B) is excluded because its cluster pair has already been accepted.
@@ -1106,10 +1280,10 @@ def test_accept_nonredundant_subchain_pairs():
 
             'O': 12,
     }
-    accepted_cluster_pairs = {
+    accepted_cluster_pairs = set_factory({
             (1,2),
             (3,3),
-    }
+    })
     accepted_candidate_indices = set()
 
     _mmc._accept_nonredundant_subchain_pairs(
@@ -1130,3 +1304,123 @@ def test_accept_nonredundant_subchain_pairs():
             (10,11),
             (12,12),
     }
+
+def test_cluster_set():
+    clusters = _mmc._ClusterSet()
+
+    assert 0 not in clusters
+    assert clusters.contains_all([])
+    assert not clusters.contains_all([0])
+
+    clusters.add(3)
+    clusters.add(20)
+
+    assert 3 in clusters
+    assert 20 in clusters
+    assert 4 not in clusters
+    assert 1000 not in clusters
+    assert clusters.contains_all([3, 20, 3])
+    assert not clusters.contains_all([3, 4])
+    assert list(clusters) == [3, 20]
+    assert len(clusters) == 2
+
+def test_cluster_pair_set():
+    pairs = _mmc._ClusterPairSet()
+
+    assert (1, 2) not in pairs
+    assert pairs.contains_all([])
+
+    # Add enough pairs to cause the pending pairs to be merged into the sorted 
+    # array at least once.
+    for i in range(2000):
+        pairs.add((i + 1, i))
+    pairs.add((1, 0))
+
+    assert (0, 1) in pairs
+    assert (1, 0) in pairs
+    assert (1999, 2000) in pairs
+    assert (0, 2) not in pairs
+    assert (2000, 2001) not in pairs
+    assert len(pairs) == 2000
+
+    keys = _mmc._pack_cluster_pairs([0, 5, 7], [1, 4, 8])
+    assert pairs.contains_all(keys)
+
+    keys = _mmc._pack_cluster_pairs([0, 5, 7], [1, 4, 9])
+    assert not pairs.contains_all(keys)
+
+def test_memento_load_sets(tmp_path):
+    # Mementos saved by older versions of this module used plain sets.
+    memento = mmc.Memento()
+    memento._accepted_clusters = {1, 2}
+    memento._accepted_cluster_pairs = {(1, 1), (1, 2)}
+    memento.save(tmp_path / 'memento.pkl')
+
+    memento = mmc.Memento.load(tmp_path / 'memento.pkl')
+
+    assert isinstance(memento._accepted_clusters, _mmc._ClusterSet)
+    assert isinstance(memento._accepted_cluster_pairs, _mmc._ClusterPairSet)
+    assert memento._accepted_clusters == {1, 2}
+    assert memento._accepted_cluster_pairs == {(1, 1), (1, 2)}
+
+def test_memento_save_parquet(tmp_path):
+    memento = mmc.Memento()
+    memento._assembly_id = 3
+    memento._accepted_clusters.add(1)
+    memento._accepted_clusters.add(17)
+    memento._accepted_cluster_pairs.add((1, 17))
+    memento._accepted_cluster_pairs.add((1, 1))
+    memento.save_parquet(tmp_path / 'memento.parquet')
+
+    assert list(tmp_path.iterdir()) == [tmp_path / 'memento.parquet']
+
+    memento = mmc.Memento.load(tmp_path / 'memento.parquet')
+
+    assert memento._assembly_id == 3
+    assert memento._accepted_clusters == {1, 17}
+    assert memento._accepted_cluster_pairs == {(1, 1), (1, 17)}
+
+    memento = mmc.Memento()
+    memento.save_parquet(tmp_path / 'memento.parquet')
+    memento = mmc.Memento.load(tmp_path / 'memento.parquet')
+
+    assert memento._assembly_id is None
+    assert memento._accepted_clusters == set()
+    assert memento._accepted_cluster_pairs == set()
+
+def test_visit_assemblies_checkpoint(tmp_path):
+    db = make_visit_db()
+    checkpoint_path = tmp_path / 'checkpoint.parquet'
+
+    class InterruptingVisitor(RecordingVisitor):
+
+        def __init__(self, structure):
+            if structure.pdb_id == '3abc':
+                raise MockInterruption
+
+            super().__init__(structure)
+
+    class MockInterruption(Exception):
+        pass
+
+    RecordingVisitor.accepted = []
+
+    try:
+        mmc.visit_assemblies(
+                db, InterruptingVisitor,
+                checkpoint_path=checkpoint_path,
+                checkpoint_every=1,
+        )
+    except MockInterruption:
+        pass
+
+    assert [x[0] for x in RecordingVisitor.accepted] == \
+            ['1abc', '2abc', '2abc']
+
+    memento = mmc.Memento.load(checkpoint_path)
+    assert memento._assembly_id == 3
+
+    mmc.visit_assemblies(db, RecordingVisitor, memento=memento)
+
+    assert [x[0] for x in RecordingVisitor.accepted] == \
+            ['1abc', '2abc', '2abc', '3abc']
@@ -2,6 +2,7 @@ import polars as pl
 import macromol_census as mmc
 import parametrize_from_file as pff
 
+from pytest import mark
 from pytest_unordered import unordered
 
 with_py = pff.Namespace()
@@ -22,7 +23,8 @@ def dataframe(df_rows, schema):
     return pl.DataFrame(rows, schema)
 
 
-def test_rank_assemblies():
+@mark.parametrize('jobs', [1, 2])
+def test_rank_assemblies(jobs):
     db = mmc.open_db(':memory:')
     #db = mmc.open_db('foo.duckdb')
     mmc.init_db(db)
@@ -106,7 +108,7 @@ def test_rank_assemblies():
             ]),
     )
 
-    ranks = mmc.rank_assemblies(db)
+    ranks = mmc.rank_assemblies(db, jobs=jobs)
     mmc.insert_assembly_ranks(db, ranks)
 
     expected = unordered([
@@ -122,8 +124,9 @@ def test_rank_assemblies():
 @pff.parametrize(
         schema=pff.cast(assembly_subchain=assembly_subchain),
 )
-def test_find_assembly_subchain_cover(assembly_subchain, expected):
-    cover = mmc.find_assembly_subchain_cover(assembly_subchain)
+@mark.parametrize('cache', [None, {}])
+def test_find_assembly_subchain_cover(assembly_subchain, cache, expected):
+    cover = mmc.find_assembly_subchain_cover(assembly_subchain, cache=cache)
     actual = list(cover['assembly_id'])
 
     assert any(
@@ -131,3 +134,30 @@ def test_find_assembly_subchain_cover(assembly_subchain, expected):
             for x in expected
     )
 
+def test_find_assembly_subchain_cover_cache():
+    cache = {}
+
+    # These are the same pattern, but with the assemblies and subchains 
+    # relabeled:
+    cover_1 = mmc.find_assembly_subchain_cover(
+            assembly_subchain(['1 A', '1 B', '2 B', '2 C', '3 C', '3 D']),
+            cache=cache,
+    )
+    cover_2 = mmc.find_assembly_subchain_cover(
+            assembly_subchain(['4 X', '5 X', '5 Y', '6 Y', '6 Z', '4 W']),
+            cache=cache,
+    )
+
+    assert len(cache) == 1
+    assert list(cover_1['assembly_id']) == unordered(['1', '3'])
+    assert list(cover_2['assembly_id']) == unordered(['4', '6'])
+
+    # This is a different pattern, so it should get its own cache entry:
+    cover_3 = mmc.find_assembly_subchain_cover(
+            assembly_subchain(['1 A', '2 B']),
+            cache=cache,
+    )
+
+    assert len(cache) == 2
+    assert list(cover_3['assembly_id']) == unordered(['1', '2'])
+
@@ -226,3 +226,41 @@ def test_rank_structures_tiebreakers():
             dict(struct_id=3, rank=2),
             dict(struct_id=1, rank=3),
     ]
+
+def test_rank_structures_incremental():
+    db = mmc.open_db(':memory:')
+    mmc.init_db(db)
+
+    def select_ranks():
+        return (
+                mmc.select_structures(db)
+                .select('pdb_id', 'rank')
+                .sort('rank')
+                .to_dicts()
+        )
+
+    insert_quality_metrics(db, '1abc', xtal_resolutions=[1.0])
+    insert_quality_metrics(db, '2abc', xtal_resolutions=[2.0])
+    insert_quality_metrics(db, '3abc', xtal_resolutions=[3.0])
+
+    assert mmc.update_structure_ranks(db, mmc.rank_structures(db)) == 3
+    assert select_ranks() == [
+            dict(pdb_id='1abc', rank=1),
+            dict(pdb_id='2abc', rank=2),
+            dict(pdb_id='3abc', rank=3),
+    ]
+
+    # Nothing changed, so nothing should be updated.
+    assert mmc.update_structure_ranks(db, mmc.rank_structures(db)) == 0
+
+    # Only the structures that are displaced by the new structure should be 
+    # updated.
+    insert_quality_metrics(db, '4abc', xtal_resolutions=[2.5])
+
+    assert mmc.update_structure_ranks(db, mmc.rank_structures(db)) == 2
+    assert select_ranks() == [
+            dict(pdb_id='1abc', rank=1),
+            dict(pdb_id='2abc', rank=2),
+            dict(pdb_id='4abc', rank=3),
+            dict(pdb_id='3abc', rank=4),
+    ]
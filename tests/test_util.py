@@ -0,0 +1,104 @@
+import polars as pl
+import macromol_census as mmc
+
+from gemmi.cif import read_string
+from polars.testing import assert_frame_equal
+from pytest import raises
+
+def test_extract_dataframe():
+    cif = read_string('''\
+data_1ABC
+loop_
+_abc.id
+_abc.name
+_abc.x
+1 'A B' 1.5
+2 ?     .
+3 .     ?
+4
+;C D
+;
+2.5
+''').sole_block()
+
+    df = mmc.extract_dataframe(
+            cif, 'abc',
+            required_cols=['id', 'name'],
+            optional_cols=['x', 'y'],
+            schema={'id': int, 'x': float, 'y': float},
+    )
+    expected = pl.DataFrame(
+            [
+                dict(id=1, name='A B', x=1.5, y=None),
+                dict(id=2, name=None, x=None, y=None),
+                dict(id=3, name=None, x=None, y=None),
+                dict(id=4, name='C D', x=2.5, y=None),
+            ],
+            schema={'id': pl.Int64, 'name': str, 'x': float, 'y': float},
+    )
+    assert_frame_equal(df, expected)
+
+def test_extract_dataframe_missing_category():
+    cif = read_string('data_1ABC\n_xyz.id 1\n').sole_block()
+
+    df = mmc.extract_dataframe(
+            cif, 'abc',
+            required_cols=['id'],
+            schema={'id': int},
+    )
+    assert_frame_equal(df, pl.DataFrame([], {'id': pl.Int64}))
+
+def test_extract_dataframe_missing_required_col():
+    cif = read_string('data_1ABC\n_abc.id 1\n').sole_block()
+
+    with raises(mmc.IngestError, match='missing required column'):
+        mmc.extract_dataframe(cif, 'abc', required_cols=['id', 'name'])
+
+def test_extract_dataframe_strict():
+    cif = read_string('data_1ABC\n_abc.x None\n').sole_block()
+
+    df = mmc.extract_dataframe(
+            cif, 'abc',
+            optional_cols=['x'],
+            schema={'x': float},
+            strict=False,
+    )
+    assert df.is_empty()
+
+    with raises(pl.exceptions.InvalidOperationError):
+        mmc.extract_dataframe(
+                cif, 'abc',
+                optional_cols=['x'],
+                schema={'x': float},
+        )
+
+def test_iter_cif_blocks(tmp_path):
+    import gzip
+
+    cif_path = tmp_path / 'blocks.cif.gz'
+    with gzip.open(cif_path, 'wt') as f:
+        f.write('''\
+# comment
+data_A
+_abc.x 1
+#
+data_B
+_abc.x
+;
+data_C
+;
+#
+DATA_D
+_abc.x 4
+''')
+
+    blocks = mmc.iter_cif_blocks(cif_path)
+
+    assert [(x.name, x.find_value('_abc.x')) for x in blocks] == [
+            ('A', '1'),
+            ('B', ';\ndata_C\n;'),
+            ('D', '4'),
+    ]
+
+    blocks = mmc.iter_cif_blocks(cif_path, block_names={'B', 'D'})
+    assert [x.name for x in blocks] == ['B', 'D']